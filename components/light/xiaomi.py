@@ -3,13 +3,17 @@ Support for Xiaomi Gateway Light.
 
 Developed by Rave from Lazcad.com
 """
+import asyncio
 import logging
 import struct
 import binascii
 try:
-    from homeassistant.components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice)
+    from homeassistant.components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice,
+                                                 SIGNAL_NEW_DEVICE, model_entities)
 except ImportError:
-    from custom_components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice)
+    from custom_components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice, SIGNAL_NEW_DEVICE,
+                                          model_entities)
+from homeassistant.helpers.dispatcher import dispatcher_connect
 from homeassistant.components.light import (
     ATTR_BRIGHTNESS, ATTR_COLOR_TEMP, ATTR_EFFECT,
     ATTR_RGB_COLOR, ATTR_WHITE_VALUE, ATTR_XY_COLOR, SUPPORT_BRIGHTNESS,
@@ -24,11 +28,20 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
     gateways = PY_XIAOMI_GATEWAY.gateways
     for (ip_add, gateway) in gateways.items():
         for device in gateway.devices['light']:
-            model = device['model']
-            if model == 'gateway':
-                devices.append(XiaomiGatewayLight(device, 'Gateway Light', gateway))
+            devices.extend(_create_entities(gateway, device))
     add_devices(devices)
 
+    def add_new_device(gateway, device):
+        """Add the entities of a device paired after startup."""
+        add_devices(_create_entities(gateway, device))
+
+    dispatcher_connect(hass, SIGNAL_NEW_DEVICE.format('light'), add_new_device)
+
+def _create_entities(gateway, device):
+    """Create the entities of a Xiaomi device."""
+    return [XiaomiGatewayLight(device, spec.name, gateway)
+            for spec in model_entities(device['model'], 'light')]
+
 
 class XiaomiGatewayLight(XiaomiDevice, Light):
     """Representation of a XiaomiGatewayLight."""
@@ -94,22 +107,27 @@ class XiaomiGatewayLight(XiaomiDevice, Light):
         """Return the supported features."""
         return SUPPORT_BRIGHTNESS | SUPPORT_RGB_COLOR
 
-    def turn_on(self, **kwargs):
+    @asyncio.coroutine
+    def async_turn_on(self, **kwargs):
         """Turn the light on."""
+        rgb = self._rgb
         if ATTR_RGB_COLOR in kwargs:
-            self._rgb = kwargs[ATTR_RGB_COLOR]
+            rgb = tuple(kwargs[ATTR_RGB_COLOR])
 
+        brightness = self._brightness
         if ATTR_BRIGHTNESS in kwargs:
-            self._brightness = int(100 * kwargs[ATTR_BRIGHTNESS] / 255)
+            brightness = kwargs[ATTR_BRIGHTNESS]
 
-        rgba = (self._brightness,) + self._rgb
+        # The gateway takes brightness as a percentage
+        rgba = (int(100 * brightness / 255),) + rgb
         rgbhex = binascii.hexlify(struct.pack('BBBB', *rgba)).decode("ASCII")
         rgbhex = int(rgbhex, 16)
 
-        if self.xiaomi_hub.write_to_hub(self._sid, self._data_key, rgbhex):
-            self._state = True
+        yield from self._async_write_state(
+            {self._data_key: rgbhex},
+            {'_state': True, '_rgb': rgb, '_brightness': brightness})
 
-    def turn_off(self, **kwargs):
+    @asyncio.coroutine
+    def async_turn_off(self, **kwargs):
         """Turn the light off."""
-        if self.xiaomi_hub.write_to_hub(self._sid, self._data_key, 0):
-            self._state = False
+        yield from self._async_write_state({self._data_key: 0}, {'_state': False})
@@ -1,79 +1,174 @@
-"""
-Support for Xiaomi sensors.
-
-Developed by Rave from Lazcad.com
-"""
-import logging
-
-try:
-    from homeassistant.components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice)
-except ImportError:
-    from custom_components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice)
-from homeassistant.const import TEMP_CELSIUS
-
-_LOGGER = logging.getLogger(__name__)
-
-def setup_platform(hass, config, add_devices, discovery_info=None):
-    """Perform the setup for Xiaomi devices."""
-    devices = []
-    gateways = PY_XIAOMI_GATEWAY.gateways
-    for (ip_add, gateway) in gateways.items():
-        for device in gateway.devices['sensor']:
-            if device['model'] == 'sensor_ht':
-                temp_info = SensorInfo('Temperature', 'temperature', TEMP_CELSIUS, 100, 0, 0.01)
-                humi_info = SensorInfo('Humidity', 'humidity', '%', 100, 0, 0.01)
-                devices.append(XiaomiSensor(device, temp_info, gateway))
-                devices.append(XiaomiSensor(device, humi_info, gateway))
-            elif device['model'] == 'gateway':
-                illu_info = SensorInfo('Illuminance', 'illumination', 'lx', 100000, 0, 1)
-                devices.append(XiaomiSensor(device, illu_info, gateway))
-    add_devices(devices)
-
-class SensorInfo(object):
-    """Xiaomi Sensor info"""
-    def __init__(self, name, data_key, units, max_value, min_value, value_modifier):
-        self.name = name
-        self.data_key = data_key
-        self.units = units
-        self.max = max_value
-        self.min = min_value
-        self.value_modifier = value_modifier
-
-class XiaomiSensor(XiaomiDevice):
-    """Representation of a XiaomiSensor."""
-
-    def __init__(self, device, sensor_info, xiaomi_hub):
-        """Initialize the XiaomiSensor."""
-        self.current_value = None
-        self._data_key = sensor_info.data_key
-        self._battery = None
-        self._units = sensor_info.units
-        self._max = sensor_info.max
-        self._min = sensor_info.min
-        self._value_modifier = sensor_info.value_modifier
-
-        XiaomiDevice.__init__(self, device, sensor_info.name, xiaomi_hub)
-
-    @property
-    def available(self):
-        """Return True if entity is available."""
-        return self.current_value > self._min and self.current_value < self._max
-
-    @property
-    def state(self):
-        """Return the name of the sensor."""
-        return self.current_value
-
-    @property
-    def unit_of_measurement(self):
-        """Return the unit of measurement of this entity, if any."""
-        return self._units
-
-    def parse_data(self, data):
-        """Parse data sent by gateway"""
-        value = data.get(self._data_key)
-        if value is None:
-            return False
-
-        self.current_value = int(value) * self._value_modifier
-        return True
+"""
+Support for Xiaomi sensors.
+
+Developed by Rave from Lazcad.com
+"""
+import logging
+import time
+from collections import namedtuple
+
+try:
+    from homeassistant.components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice, DOMAIN,
+                                                 SIGNAL_NEW_DEVICE, model_entities)
+except ImportError:
+    from custom_components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice, DOMAIN,
+                                          SIGNAL_NEW_DEVICE, model_entities)
+from homeassistant.const import TEMP_CELSIUS
+from homeassistant.helpers.dispatcher import dispatcher_connect
+from homeassistant.helpers.entity import Entity
+
+_LOGGER = logging.getLogger(__name__)
+
+def setup_platform(hass, config, add_devices, discovery_info=None):
+    """Perform the setup for Xiaomi devices."""
+    devices = []
+    gateways = PY_XIAOMI_GATEWAY.gateways
+    for (ip_add, gateway) in gateways.items():
+        for device in gateway.devices['sensor']:
+            devices.extend(_create_entities(gateway, device))
+
+    if hass.data[DOMAIN]['stats']:
+        devices.extend(_stats_sensors(PY_XIAOMI_GATEWAY.stats, gateways.values()))
+    add_devices(devices)
+
+    def add_new_device(gateway, device):
+        """Add the entities of a device paired after startup."""
+        add_devices(_create_entities(gateway, device))
+
+    dispatcher_connect(hass, SIGNAL_NEW_DEVICE.format('sensor'), add_new_device)
+
+def _create_entities(gateway, device):
+    """Create the entities of a Xiaomi device."""
+    return [XiaomiSensor(device, SENSOR_INFO[spec.data_key], gateway)
+            for spec in model_entities(device['model'], 'sensor')]
+
+def _stats_sensors(stats, gateways):
+    """Create the sensors exposing the message pipeline statistics."""
+    sensors = [
+        XiaomiPacketRateSensor('Xiaomi Packet Rate',
+                               lambda: sum(stats.packets.values()),
+                               lambda: dict(stats.models)),
+        XiaomiStatsSensor('Xiaomi Dispatch Latency', 'ms',
+                          lambda: stats.dispatch.percentile(0.95),
+                          stats.dispatch.as_dict),
+        XiaomiStatsSensor('Xiaomi Ack RTT', 'ms',
+                          lambda: stats.ack_rtt.percentile(0.5),
+                          stats.ack_rtt.as_dict),
+        XiaomiStatsSensor('Xiaomi Command Timeouts', 'commands',
+                          lambda: sum(stats.timeouts.values()),
+                          lambda: dict(stats.timeouts)),
+        XiaomiStatsSensor('Xiaomi Dropped Packets', 'packets',
+                          lambda: stats.decode_errors + stats.unknown_gateway,
+                          lambda: {'decode_errors': stats.decode_errors,
+                                   'unknown_gateway': stats.unknown_gateway}),
+    ]
+    for gateway in gateways:
+        sensors.append(XiaomiPacketRateSensor(
+            'Xiaomi Packet Rate {}'.format(gateway.sid),
+            lambda sid=gateway.sid: stats.packets[sid]))
+    return sensors
+
+# Xiaomi Sensor info, one shared instance per measured quantity
+SensorInfo = namedtuple('SensorInfo', ['name', 'data_key', 'units', 'max', 'min',
+                                       'value_modifier'])
+
+TEMPERATURE_INFO = SensorInfo('Temperature', 'temperature', TEMP_CELSIUS, 100, 0, 0.01)
+HUMIDITY_INFO = SensorInfo('Humidity', 'humidity', '%', 100, 0, 0.01)
+ILLUMINANCE_INFO = SensorInfo('Illuminance', 'illumination', 'lx', 100000, 0, 1)
+
+SENSOR_INFO = {info.data_key: info
+               for info in (TEMPERATURE_INFO, HUMIDITY_INFO, ILLUMINANCE_INFO)}
+
+class XiaomiSensor(XiaomiDevice):
+    """Representation of a XiaomiSensor."""
+
+    def __init__(self, device, sensor_info, xiaomi_hub):
+        """Initialize the XiaomiSensor."""
+        self.current_value = None
+        self._data_key = sensor_info.data_key
+        self._info = sensor_info
+
+        XiaomiDevice.__init__(self, device, sensor_info.name, xiaomi_hub)
+
+    @property
+    def available(self):
+        """Return True if entity is available."""
+        return (super().available and self.current_value is not None and
+                self._info.min < self.current_value < self._info.max)
+
+    @property
+    def state(self):
+        """Return the name of the sensor."""
+        return self.current_value
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement of this entity, if any."""
+        return self._info.units
+
+    def parse_data(self, data):
+        """Parse data sent by gateway"""
+        value = data.get(self._data_key)
+        if value is None:
+            return False
+
+        self.current_value = int(value) * self._info.value_modifier
+        return True
+
+class XiaomiStatsSensor(Entity):
+    """Representation of a Xiaomi message pipeline statistic."""
+
+    def __init__(self, name, units, value_fn, attributes_fn=None):
+        """Initialize the XiaomiStatsSensor."""
+        self._name = name
+        self._units = units
+        self._value_fn = value_fn
+        self._attributes_fn = attributes_fn
+        self._state = None
+        self._attributes = {}
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._state
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement of this entity, if any."""
+        return self._units
+
+    @property
+    def device_state_attributes(self):
+        """Return the state attributes."""
+        return self._attributes
+
+    def update(self):
+        """Read the statistic."""
+        self._state = self._value_fn()
+        if self._attributes_fn is not None:
+            self._attributes = self._attributes_fn()
+
+class XiaomiPacketRateSensor(XiaomiStatsSensor):
+    """Packets per second derived from a packet counter."""
+
+    def __init__(self, name, count_fn, attributes_fn=None):
+        """Initialize the XiaomiPacketRateSensor."""
+        XiaomiStatsSensor.__init__(self, name, 'packets/s', count_fn, attributes_fn)
+        self._last_count = None
+        self._last_time = None
+
+    def update(self):
+        """Compute the rate since the previous update."""
+        count = self._value_fn()
+        now = time.monotonic()
+        if self._last_count is not None and now > self._last_time:
+            self._state = round((count - self._last_count) / (now - self._last_time), 2)
+        self._last_count = count
+        self._last_time = now
+        if self._attributes_fn is not None:
+            self._attributes = self._attributes_fn()
@@ -1,105 +1,166 @@
-"""
-Support for Xiaomi binary sensors.
-
-Developed by Rave from Lazcad.com
-"""
-import logging
-
-from homeassistant.components.switch import SwitchDevice
-try:
-    from homeassistant.components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice)
-except ImportError:
-    from custom_components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice)
-
-_LOGGER = logging.getLogger(__name__)
-
-ATTR_LOAD_POWER = 'Load power' # Load power in watts (W)
-ATTR_POWER_CONSUMED = 'Power consumed' #Load power consumption in kilowatt hours (kWh)
-ATTR_IN_USE = 'In use'
-LOAD_POWER = 'load_power'
-POWER_CONSUMED = 'power_consumed'
-IN_USE = 'inuse'
-
-def setup_platform(hass, config, add_devices, discovery_info=None):
-    """Perform the setup for Xiaomi devices."""
-    devices = []
-    gateways = PY_XIAOMI_GATEWAY.gateways
-    for (ip_add, gateway) in gateways.items():
-        for device in gateway.devices['switch']:
-            model = device['model']
-            if model == 'plug':
-                devices.append(XiaomiGenericSwitch(device, "Plug", 'status', gateway))
-            elif model == 'ctrl_neutral1':
-                devices.append(XiaomiGenericSwitch(device, 'Wall Switch', 'channel_0', gateway))
-            elif model == 'ctrl_neutral2':
-                devices.append(XiaomiGenericSwitch(device, 'Wall Switch Left', 'channel_0', gateway))
-                devices.append(XiaomiGenericSwitch(device, 'Wall Switch Right', 'channel_1', gateway))
-            elif (model == '86plug'):
-                devices.append(XiaomiGenericSwitch(device, 'Wall Plug', 'status', gateway))
-    add_devices(devices)
-
-
-class XiaomiGenericSwitch(XiaomiDevice, SwitchDevice):
-    """Representation of a XiaomiPlug."""
-
-    def __init__(self, device, name, data_key, xiaomi_hub):
-        """Initialize the XiaomiPlug."""
-        self._state = False
-        self._data_key = data_key
-        self._in_use = False
-        self._load_power = 0
-        self._power_consumed = 0
-        XiaomiDevice.__init__(self, device, name, xiaomi_hub)
-
-    @property
-    def icon(self):
-        """Return the icon to use in the frontend, if any."""
-        if self._data_key == 'status':
-            return 'mdi:power-plug'
-        else:
-            return 'mdi:power-socket'
-
-    @property
-    def is_on(self):
-        """Return true if plug is on."""
-        return self._state
-
-    @property
-    def device_state_attributes(self):
-        """Return the state attributes."""
-        attrs = {ATTR_IN_USE: self._in_use,
-                 ATTR_LOAD_POWER: self._load_power,
-                 ATTR_POWER_CONSUMED: self._power_consumed}
-        attrs.update(super().device_state_attributes)
-        return attrs
-    def turn_on(self, **kwargs):
-        """Turn the switch on."""
-        self.xiaomi_hub.write_to_hub(self._sid, self._data_key, 'on')
-
-    def turn_off(self):
-        """Turn the switch off."""
-        self.xiaomi_hub.write_to_hub(self._sid, self._data_key, 'off')
-
-    def parse_data(self, data):
-        """Parse data sent by gateway"""
-        if IN_USE in data:
-            self._in_use = int(data[IN_USE])
-            if not self._in_use:
-                self._load_power = 0
-
-        if POWER_CONSUMED in data:
-            self._power_consumed = int(data[POWER_CONSUMED])
-
-        if LOAD_POWER in data:
-            self._load_power = int(data[LOAD_POWER])
-
-        value = data.get(self._data_key)
-        if value is None:
-            return False
-
-        state = value == 'on'
-        if self._state == state:
-            return False
-        else:
-            self._state = state
-            return True
+"""
+Support for Xiaomi switches.
+
+Developed by Rave from Lazcad.com
+"""
+import asyncio
+import logging
+import time
+
+from homeassistant.components.switch import SwitchDevice
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import dispatcher_connect
+try:
+    from homeassistant.components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice, DOMAIN,
+                                                 VOLTAGE, SIGNAL_NEW_DEVICE, model_entities)
+except ImportError:
+    from custom_components.xiaomi import (PY_XIAOMI_GATEWAY, XiaomiDevice, DOMAIN, VOLTAGE,
+                                          SIGNAL_NEW_DEVICE, model_entities)
+
+_LOGGER = logging.getLogger(__name__)
+
+ATTR_LOAD_POWER = 'Load power' # Load power in watts (W)
+ATTR_POWER_CONSUMED = 'Power consumed' #Load power consumption in kilowatt hours (kWh)
+ATTR_IN_USE = 'In use'
+LOAD_POWER = 'load_power'
+POWER_CONSUMED = 'power_consumed'
+IN_USE = 'inuse'
+
+def setup_platform(hass, config, add_devices, discovery_info=None):
+    """Perform the setup for Xiaomi devices."""
+    devices = []
+    gateways = PY_XIAOMI_GATEWAY.gateways
+    for (ip_add, gateway) in gateways.items():
+        for device in gateway.devices['switch']:
+            devices.extend(_create_entities(hass, gateway, device))
+    add_devices(devices)
+
+    def add_new_device(gateway, device):
+        """Add the entities of a device paired after startup."""
+        add_devices(_create_entities(hass, gateway, device))
+
+    dispatcher_connect(hass, SIGNAL_NEW_DEVICE.format('switch'), add_new_device)
+
+def _create_entities(hass, gateway, device):
+    """Create the entities of a Xiaomi device."""
+    return [XiaomiGenericSwitch(device, spec.name, spec.data_key, hass, gateway)
+            for spec in model_entities(device['model'], 'switch')]
+
+
+class XiaomiGenericSwitch(XiaomiDevice, SwitchDevice):
+    """Representation of a XiaomiPlug."""
+
+    DEFAULT_ATTRIBUTES = {ATTR_IN_USE: False, ATTR_LOAD_POWER: 0, ATTR_POWER_CONSUMED: 0}
+
+    def __init__(self, device, name, data_key, hass, xiaomi_hub):
+        """Initialize the XiaomiPlug."""
+        self._state = False
+        self._data_key = data_key
+        self._in_use = False
+        self._load_power = 0
+        self._power_consumed = 0
+        self._power_deadband = hass.data[DOMAIN]['power_deadband']
+        self._power_interval = hass.data[DOMAIN]['power_interval']
+        self._published_power = None
+        self._published_consumed = None
+        self._published_at = 0
+        self._power_timer = None
+        XiaomiDevice.__init__(self, device, name, xiaomi_hub)
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend, if any."""
+        if self._data_key == 'status':
+            return 'mdi:power-plug'
+        else:
+            return 'mdi:power-socket'
+
+    @property
+    def is_on(self):
+        """Return true if plug is on."""
+        return self._state
+
+    @property
+    def data_keys(self):
+        """Return the report keys consumed by the device."""
+        return (self._data_key, IN_USE, LOAD_POWER, POWER_CONSUMED, VOLTAGE)
+
+    @asyncio.coroutine
+    def async_turn_on(self, **kwargs):
+        """Turn the switch on."""
+        yield from self._async_write_state(self.command_data(True), {'_state': True})
+
+    @asyncio.coroutine
+    def async_turn_off(self, **kwargs):
+        """Turn the switch off."""
+        yield from self._async_write_state(self.command_data(False), {'_state': False})
+
+    def command_data(self, state):
+        """Return the write data that turns the switch on or off."""
+        return {self._data_key: 'on' if state else 'off'}
+
+    def parse_data(self, data):
+        """Parse data sent by gateway"""
+        in_use_changed = False
+        if IN_USE in data:
+            in_use = int(data[IN_USE])
+            in_use_changed = in_use != self._in_use
+            self._in_use = in_use
+            if not self._in_use:
+                self._load_power = 0
+
+        if POWER_CONSUMED in data:
+            self._power_consumed = int(data[POWER_CONSUMED])
+
+        if LOAD_POWER in data:
+            self._load_power = int(data[LOAD_POWER])
+
+        value = data.get(self._data_key)
+        state = self._state if value is None else value == 'on'
+        if self._state != state or in_use_changed:
+            self._state = state
+            self._mark_power_published()
+            return True
+
+        return self._should_publish_power()
+
+    def _should_publish_power(self):
+        """Coalesce metering reports.
+
+        Power values are published when load power moved by at least the
+        deadband, or when anything changed and the last publish is older
+        than the interval. A change held back is published once the
+        interval has passed, even if no further report arrives.
+        """
+        if (self._load_power == self._published_power and
+                self._power_consumed == self._published_consumed):
+            return False
+        if (self._published_power is not None and
+                abs(self._load_power - self._published_power) < self._power_deadband):
+            remaining = self._published_at + self._power_interval - time.monotonic()
+            if remaining > 0:
+                if self._power_timer is None and self.hass is not None:
+                    self._power_timer = self.xiaomi_hub.timers.schedule(
+                        remaining, self._async_publish_power)
+                return False
+        self._mark_power_published()
+        return True
+
+    @callback
+    def _async_publish_power(self):
+        self._power_timer = None
+        if (self._load_power != self._published_power or
+                self._power_consumed != self._published_consumed):
+            self._mark_power_published()
+            self.async_schedule_update_ha_state()
+
+    def _mark_power_published(self):
+        if self._power_timer is not None:
+            self.xiaomi_hub.timers.cancel(self._power_timer)
+            self._power_timer = None
+        self._published_power = self._load_power
+        self._published_consumed = self._power_consumed
+        self._published_at = time.monotonic()
+        self._device_state_attributes[ATTR_IN_USE] = self._in_use
+        self._device_state_attributes[ATTR_LOAD_POWER] = self._load_power
+        self._device_state_attributes[ATTR_POWER_CONSUMED] = self._power_consumed
@@ -1,529 +1,2071 @@
-"""
-Support for Xiaomi Gateways.
-
-Developed by Rave from Lazcad.com
-"""
-
-import socket
-import json
-import logging
-import struct
-import platform
-import voluptuous as vol
-import homeassistant.helpers.config_validation as cv
-from threading import Thread
-from collections import defaultdict
-from homeassistant.helpers import discovery
-from homeassistant.helpers.entity import Entity
-from homeassistant.const import ATTR_BATTERY_LEVEL, EVENT_HOMEASSISTANT_STOP
-
-REQUIREMENTS = ['pyCrypto==2.6.1']
-
-DOMAIN = 'xiaomi'
-CONF_GATEWAYS = 'gateways'
-CONF_INTERFACE = 'interface'
-CONF_POLL_MOTION = 'poll_motion'
-CONF_DISCOVERY_RETRY = 'discovery_retry'
-
-DEFAULT_KEY = "xxxxxxxxxxxxxxxx"
-
-CONFIG_SCHEMA = vol.Schema({
-    DOMAIN: vol.Schema({
-        vol.Optional(CONF_GATEWAYS, default=[{"sid": None, "key": DEFAULT_KEY}]): cv.ensure_list,
-        vol.Optional(CONF_INTERFACE, default='any'): cv.string,
-        vol.Optional(CONF_POLL_MOTION, default=False): cv.boolean,
-        vol.Optional(CONF_DISCOVERY_RETRY, default=3): cv.positive_int
-    })
-}, extra=vol.ALLOW_EXTRA)
-
-XIAOMI_COMPONENTS = ['binary_sensor', 'sensor', 'switch', 'light']
-PY_XIAOMI_GATEWAY = None
-
-# Shortcut for the logger
-_LOGGER = logging.getLogger(__name__)
-
-ATTR_RINGTONE_ID = 'ringtone_id'
-ATTR_RINGTONE_VOL = 'ringtone_vol'
-ATTR_GW_SID = 'gw_sid'
-
-def setup(hass, config):
-    """Set up the Xiaomi component."""
-
-    hass.data[DOMAIN] = {}
-    hass.data[DOMAIN]['poll_motion'] = config[DOMAIN][CONF_POLL_MOTION]
-
-    gateways = config[DOMAIN][CONF_GATEWAYS]
-    interface = config[DOMAIN][CONF_INTERFACE]
-    discovery_retry = config[DOMAIN][CONF_DISCOVERY_RETRY]
-
-    for gateway in gateways:
-        sid = gateway['sid']
-
-        if sid != None:
-            gateway['sid'] = gateway['sid'].replace(":", "").lower()
-
-        key = gateway['key']
-        if key == DEFAULT_KEY:
-            _LOGGER.warning('Gateway Key is not provided. Only sensors will be loaded.')
-
-        if len(key) != 16:
-            _LOGGER.error('Invalid key %s. Key must be 16 characters', key)
-            return False
-
-    global PY_XIAOMI_GATEWAY
-    PY_XIAOMI_GATEWAY = PyXiaomiGateway(hass, gateways, interface)
-
-    _LOGGER.info("Expecting %s gateways", len(gateways))
-    for _ in range(discovery_retry):
-        _LOGGER.info('Discovering Xiaomi Gateways (Try %s)', _ + 1)
-        PY_XIAOMI_GATEWAY.discover_gateways()
-        if len(PY_XIAOMI_GATEWAY.gateways) >= len(gateways):
-            break
-
-    if len(PY_XIAOMI_GATEWAY.gateways) == 0:
-        _LOGGER.error("No gateway discovered")
-        return False
-
-    PY_XIAOMI_GATEWAY.listen()
-    _LOGGER.info("Listening for broadcast")
-
-    def stop_xiaomi(event):
-        """Stop Xiaomi Socket."""
-        _LOGGER.info("Shutting down Xiaomi Hub.")
-        PY_XIAOMI_GATEWAY.stop_listen()
-
-    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, stop_xiaomi)
-
-    for component in XIAOMI_COMPONENTS:
-        discovery.load_platform(hass, component, DOMAIN, {}, config)
-
-
-    def play_ringtone_service(call):
-        """Service to play ringtone through Gateway."""
-        if call.data.get(ATTR_RINGTONE_ID) is None:
-            _LOGGER.error("Mandatory parameters is not specified.")
-            return
-        if (len(PY_XIAOMI_GATEWAY.gateways) != 1) and call.data.get(ATTR_GW_SID) is None:
-            _LOGGER.error("Mandatory parameters is not specified.")
-            return
-
-        ring_id = int(call.data.get(ATTR_RINGTONE_ID))
-
-        if ring_id in [9, 14-19]:
-            _LOGGER.error('Specified mid: %s is not defined in gateway.', mid)
-            return
-
-        ring_vol = call.data.get(ATTR_RINGTONE_VOL)
-        if ring_vol is None:
-            ringtone = {'mid': ring_id}
-        else:
-            ringtone = {'mid': ring_id, 'vol': int(ring_vol)}
-
-        gw_sid = call.data.get(ATTR_GW_SID)
-
-        gateways = PY_XIAOMI_GATEWAY.gateways
-        for (ip_add, gateway) in gateways.items():
-            if len(gateways) == 1:
-                gateway.write_to_hub_multi(gateway.sid, **ringtone)
-                break
-            elif gateway.sid == gw_sid:
-                gateway.write_to_hub_multi(gateway.sid, **ringtone)
-                break
-        else:
-            _LOGGER.error('Unknown gateway sid: %s was specified.', gw_sid)
-
-    def stop_ringtone_service(call):
-        """Service to stop playing ringtone on Gateway."""
-        if (len(PY_XIAOMI_GATEWAY.gateways) != 1) and call.data.get(ATTR_GW_SID) is None:
-            _LOGGER.error("Mandatory parameters is not specified.")
-            return
-
-        gw_sid = call.data.get(ATTR_GW_SID)
-
-        gateways = PY_XIAOMI_GATEWAY.gateways
-        for (ip_add, gateway) in gateways.items():
-            if len(gateways) == 1:
-                gateway.write_to_hub(gateway.sid, 'mid', 10000)
-                break
-            elif gateway.sid == gw_sid:
-                gateway.write_to_hub(gateway.sid, 'mid', 10000)
-                break
-        else:
-            _LOGGER.error('Unknown gateway sid: %s was specified.', gw_sid)
-
-    hass.services.async_register(DOMAIN, 'play_ringtone', play_ringtone_service, description=None, schema=None)
-    hass.services.async_register(DOMAIN, 'stop_ringtone', stop_ringtone_service, description=None, schema=None)
-
-    return True
-
-
-class PyXiaomiGateway:
-    """PyXiami."""
-    MULTICAST_ADDRESS = '224.0.0.50'
-    MULTICAST_PORT = 9898
-    GATEWAY_DISCOVERY_PORT = 4321
-    SOCKET_BUFSIZE = 1024
-
-    gateways = defaultdict(list)
-
-    def __init__(self, hass, gateways_config, interface):
-
-        self.hass = hass
-        self._listening = False
-        self._mcastsocket = None
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-        if interface != 'any':
-            self._socket.bind((interface, 0))
-
-        self._threads = []
-        self._gateways_config = gateways_config
-        self._interface = interface
-
-    def discover_gateways(self):
-        """Discover gateways using multicast"""
-
-        _socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if self._interface != 'any':
-            _socket.bind((self._interface, 0))
-
-        try:
-            _socket.sendto('{"cmd":"whois"}'.encode(),
-                           (self.MULTICAST_ADDRESS, self.GATEWAY_DISCOVERY_PORT))
-
-            _socket.settimeout(5.0)
-
-            while True:
-                data, addr = _socket.recvfrom(1024)
-                if len(data) is None:
-                    continue
-
-                resp = json.loads(data.decode())
-                if resp["cmd"] != 'iam':
-                    _LOGGER.error("Response does not match return cmd")
-                    continue
-
-                if resp["model"] != 'gateway':
-                    _LOGGER.error("Response must be gateway model")
-                    continue
-
-                ip_add = resp["ip"]
-                if ip_add in self.gateways:
-                    continue
-
-                gateway_key = ''
-                for gateway in self._gateways_config:
-                    sid = gateway['sid']
-                    key = gateway['key']
-                    if sid is None or sid == resp["sid"]:
-                        gateway_key = key
-
-                sid = resp["sid"]
-                port = resp["port"]
-
-                #Info to fill in API key in Configuration.xml
-                if gateway_key == DEFAULT_KEY:
-                    _LOGGER.warning('To enable discovery of switches, fill in API key in configuration.xml sid = %s', sid)
-
-                _LOGGER.info('Xiaomi Gateway %s found at IP %s', sid, ip_add)
-
-                self.gateways[ip_add] = XiaomiGateway(ip_add, port, sid, gateway_key, self._socket)
-
-        except socket.timeout:
-            _LOGGER.info("Gateway finding finished in 5 seconds")
-            _socket.close()
-
-    def _create_mcast_socket(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        if self._interface != 'any':
-            if platform.system() != "Windows":
-                sock.bind((self.MULTICAST_ADDRESS, self.MULTICAST_PORT))
-            else:
-                sock.bind((self._interface, self.MULTICAST_PORT))
-
-            mreq = socket.inet_aton(self.MULTICAST_ADDRESS) + socket.inet_aton(self._interface)
-        else:
-            sock.bind((self.MULTICAST_ADDRESS, self.MULTICAST_PORT))
-            mreq = struct.pack("4sl", socket.inet_aton(self.MULTICAST_ADDRESS), socket.INADDR_ANY)
-
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-        return sock
-
-    def listen(self):
-        """Start listening."""
-
-        _LOGGER.info('Creating Multicast Socket')
-        self._mcastsocket = self._create_mcast_socket()
-        self._listening = True
-        thread = Thread(target=self._listen_to_msg, args=())
-        self._threads.append(thread)
-        thread.daemon = True
-        thread.start()
-
-    def stop_listen(self):
-        """Stop listening."""
-        self._listening = False
-
-        if self._socket is not None:
-            _LOGGER.info('Closing socket')
-            self._socket.close()
-            self._socket = None
-
-        if self._mcastsocket is not None:
-            _LOGGER.info('Closing multisocket')
-            self._mcastsocket.close()
-            self._mcastsocket = None
-
-        for thread in self._threads:
-            thread.join()
-
-    def _listen_to_msg(self):
-        while self._listening:
-            if self._mcastsocket is None:
-                continue
-            data, (ip_add, port) = self._mcastsocket.recvfrom(self.SOCKET_BUFSIZE)
-            try:
-                data = json.loads(data.decode("ascii"))
-                gateway = self.gateways.get(ip_add)
-                if gateway is None:
-                    _LOGGER.error('Unknown gateway ip %s', ip_add)
-                    continue
-
-                cmd = data['cmd']
-                if cmd == 'heartbeat' and data['model'] == 'gateway':
-                    gateway.update_key(data['token'])
-                elif cmd == 'report' or cmd == 'heartbeat':
-                    _LOGGER.debug('MCAST (%s) << %s', cmd, data)
-                    self.hass.add_job(gateway.push_data, data)
-
-                else:
-                    _LOGGER.error('Unknown multicast data : %s', data)
-            except Exception:
-                _LOGGER.error('Cannot process multicast message : %s', data)
-                continue
-
-class XiaomiGateway:
-    """Xiaomi Gateway Component"""
-
-    def __init__(self, ip, port, sid, key, sock):
-
-        self.ip_add = ip
-        self.port = int(port)
-        self.sid = sid
-        self.key = key
-        self.devices = defaultdict(list)
-        self.ha_devices = defaultdict(list)
-        self._key = None
-
-        self._socket = sock
-
-        trycount = 5
-        for _ in range(trycount):
-            _LOGGER.info('Discovering Xiaomi Devices')
-            if self._discover_devices():
-                break
-
-    def _discover_devices(self):
-
-        cmd = '{"cmd" : "get_id_list"}'
-        resp = self._send_cmd(cmd, "get_id_list_ack")
-        if resp is None or "token" not in resp or "data" not in resp:
-            return False
-        self.update_key(resp["token"])
-        sids = json.loads(resp["data"])
-        sids.append(self.sid)
-
-        _LOGGER.info('Found %s devices', len(sids))
-
-        sensors = ['sensor_ht', 'gateway']
-        binary_sensors = ['magnet', 'motion', 'switch', '86sw1', '86sw2', 'cube', 'smoke', 'natgas']
-        switches = ['plug', 'ctrl_neutral1', 'ctrl_neutral2', '86plug']
-        lights = ['gateway']
-
-        for sid in sids:
-            cmd = '{"cmd":"read","sid":"' + sid + '"}'
-            resp = self._send_cmd(cmd, "read_ack")
-            if resp is None:
-                continue
-            data = json.loads(resp["data"])
-            if "error" in data:
-                _LOGGER.error("Not a device")
-                continue
-
-            model = resp["model"]
-            device_type = None
-
-            xiaomi_device = {
-                "model":model,
-                "sid":resp["sid"],
-                "short_id":resp["short_id"],
-                "data":data
-            }
-
-            if model in sensors:
-                device_type = 'sensor'
-                self.devices[device_type].append(xiaomi_device)
-
-            if model in binary_sensors:
-                device_type = 'binary_sensor'
-                self.devices[device_type].append(xiaomi_device)
-
-            if model in switches:
-                device_type = 'switch'
-                #Ignore switches without API key
-                if self.key != DEFAULT_KEY:
-                    self.devices[device_type].append(xiaomi_device)
-
-            if model in lights:
-                device_type = 'light'
-                #Ignore switches without API key
-                if self.key != DEFAULT_KEY:
-                    self.devices[device_type].append(xiaomi_device)
-
-            if device_type is None:
-                _LOGGER.error('Unsupported devices : %s', model)
-
-        return True
-
-    def _send_cmd(self, cmd, rtn_cmd):
-        try:
-            self._socket.settimeout(10.0)
-            _LOGGER.debug(">> %s", cmd.encode())
-            self._socket.sendto(cmd.encode(), (self.ip_add, self.port))
-            data, addr = self._socket.recvfrom(1024)
-        except socket.timeout:
-            _LOGGER.error("Cannot connect to Gateway")
-            return None
-        if data is None:
-            _LOGGER.error("No response from Gateway")
-            return None
-        resp = json.loads(data.decode())
-        _LOGGER.debug("<< %s", resp)
-        if resp['cmd'] != rtn_cmd:
-            _LOGGER.error("Non matching response. Expecting %s, but got %s", rtn_cmd, resp['cmd'])
-            return None
-        return resp
-
-    def write_to_hub(self, sid, data_key, datavalue):
-        """Send data to gateway to turn on / off device"""
-        data = {}
-        data[data_key] = datavalue
-        if self._key is None:
-            return False
-        data['key'] = self._key
-        cmd = {}
-        cmd['cmd'] = 'write'
-        cmd['sid'] = sid
-        cmd['data'] = data
-        cmd = json.dumps(cmd)
-        resp = self._send_cmd(cmd, "write_ack")
-        return self._validate_data(resp)
-
-    def write_to_hub_multi(self, sid, **kwargs):
-        """Send data to gateway to turn on / off device"""
-        data = {}
-        for key in kwargs:
-            data[key] = kwargs[key]
-        if self._key is None:
-            return False
-        data['key'] = self._key
-        cmd = {}
-        cmd['cmd'] = 'write'
-        cmd['sid'] = sid
-        cmd['data'] = data
-        cmd = json.dumps(cmd)
-        resp = self._send_cmd(cmd, "write_ack")
-        return self._validate_data(resp)
-
-    def get_from_hub(self, sid):
-        """Get data from gateway"""
-        cmd = '{ "cmd":"read","sid":"' + sid + '"}'
-        resp = self._send_cmd(cmd, "read_ack")
-        return self.push_data(resp)
-
-    def push_data(self, data):
-        """Push data broadcasted from gateway to device"""
-        if not self._validate_data(data):
-            return False
-        jdata = json.loads(data['data'])
-        if jdata is None:
-            return False
-        sid = data['sid']
-        for device in self.ha_devices[sid]:
-            device.push_data(jdata)
-        return True
-
-    def update_key(self, token):
-        """Update key using token from gateway"""
-        from Crypto.Cipher import AES
-        init_vector = bytes(bytearray.fromhex('17996d093d28ddb3ba695a2e6f58562e'))
-        encryptor = AES.new(self.key.encode(), AES.MODE_CBC, IV=init_vector)
-        ciphertext = encryptor.encrypt(token.encode())
-        self._key = ''.join('{:02x}'.format(x) for x in ciphertext)
-
-    def _validate_data(self, data):
-        if data is None or "data" not in data:
-            _LOGGER.error('No data in response from hub %s', data)
-            return False
-        if 'error' in data['data']:
-            _LOGGER.error('Got error element in data %s', data['data'])
-            return False
-        return True
-
-class XiaomiDevice(Entity):
-    """Representation a base Xiaomi device."""
-
-    def __init__(self, device, name, xiaomi_hub):
-        """Initialize the xiaomi device."""
-        self._sid = device['sid']
-        self._name = '{}_{}'.format(name, self._sid)
-        self._device_state_attributes = {}
-        self.xiaomi_hub = xiaomi_hub
-
-        self.parse_data(device['data'])
-        self._parse_voltage(device['data'])
-
-        xiaomi_hub.ha_devices[self._sid].append(self)
-
-    @property
-    def name(self):
-        """Return the name of the device."""
-        return self._name
-
-    @property
-    def should_poll(self):
-        """Poll update device status"""
-        return False
-
-    @property
-    def device_state_attributes(self):
-        """Return the state attributes."""
-        return self._device_state_attributes
-
-    def push_data(self, data):
-        """Push from Hub"""
-        _LOGGER.debug("PUSH >> %s: %s", self, data)
-
-        self._parse_voltage(data)
-
-        if self.parse_data(data):
-            self.schedule_update_ha_state()
-
-    def parse_data(self, data):
-        """Parse data sent by gateway"""
-        raise NotImplementedError()
-
-    def _parse_voltage(self, data):
-        if 'voltage' in data:
-            max_volt = 3300
-            min_volt = 2800
-
-            voltage = data['voltage']
-            if voltage > max_volt:
-                voltage = max_volt
-            elif voltage < min_volt:
-                voltage = min_volt
-            percent = ((voltage - min_volt) / (max_volt - min_volt)) * 100
-            self._device_state_attributes[ATTR_BATTERY_LEVEL] = round(percent)
+"""
+Support for Xiaomi Gateways.
+
+Developed by Rave from Lazcad.com
+"""
+
+import asyncio
+import binascii
+import bisect
+import copy
+import heapq
+import socket
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import platform
+import random
+import time
+import zlib
+import voluptuous as vol
+import homeassistant.helpers.config_validation as cv
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from homeassistant.core import callback
+from homeassistant.helpers import discovery
+from homeassistant.helpers.dispatcher import async_dispatcher_send
+from homeassistant.helpers.entity import Entity
+from homeassistant.const import (ATTR_BATTERY_LEVEL, ATTR_ENTITY_ID, EVENT_HOMEASSISTANT_START,
+                                 EVENT_HOMEASSISTANT_STOP)
+
+REQUIREMENTS = ['pyCrypto==2.6.1']
+
+DOMAIN = 'xiaomi'
+CONF_GATEWAYS = 'gateways'
+CONF_INTERFACE = 'interface'
+CONF_POLL_MOTION = 'poll_motion'
+CONF_DISCOVERY_RETRY = 'discovery_retry'
+CONF_POWER_DEADBAND = 'power_deadband'
+CONF_POWER_INTERVAL = 'power_interval'
+CONF_STATS = 'stats'
+CONF_CAPTURE = 'capture'
+CONF_COMMAND_TIMEOUT = 'command_timeout'
+CONF_COMMAND_RETRIES = 'command_retries'
+CONF_OPTIMISTIC = 'optimistic'
+CONF_STALE_AFTER = 'stale_after'
+CONF_WORKERS = 'workers'
+
+DEFAULT_KEY = "xxxxxxxxxxxxxxxx"
+KEY_INIT_VECTOR = 0x17996d093d28ddb3ba695a2e6f58562e
+
+# Seconds without a report or heartbeat after which a device is unavailable.
+# Battery devices send a heartbeat about once an hour, powered ones every
+# ten minutes.
+STALE_AFTER = {
+    'default': 7200,
+    'plug': 1800,
+    '86plug': 1800,
+    'ctrl_neutral1': 1800,
+    'ctrl_neutral2': 1800,
+}
+
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.Schema({
+        vol.Optional(CONF_GATEWAYS, default=[{"sid": None, "key": DEFAULT_KEY}]): cv.ensure_list,
+        vol.Optional(CONF_INTERFACE, default='any'): cv.string,
+        vol.Optional(CONF_POLL_MOTION, default=False): cv.boolean,
+        vol.Optional(CONF_DISCOVERY_RETRY, default=3): cv.positive_int,
+        vol.Optional(CONF_POWER_DEADBAND, default=5): vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_POWER_INTERVAL, default=300): cv.positive_int,
+        vol.Optional(CONF_STATS, default=False): cv.boolean,
+        vol.Optional(CONF_CAPTURE): cv.string,
+        vol.Optional(CONF_COMMAND_TIMEOUT, default=5.0):
+            vol.All(vol.Coerce(float), vol.Range(min=0.1)),
+        vol.Optional(CONF_COMMAND_RETRIES, default=2): cv.positive_int,
+        vol.Optional(CONF_OPTIMISTIC, default=False): cv.boolean,
+        vol.Optional(CONF_STALE_AFTER, default={}): {cv.string: cv.positive_int},
+        vol.Optional(CONF_WORKERS, default=0): cv.positive_int
+    })
+}, extra=vol.ALLOW_EXTRA)
+
+XIAOMI_COMPONENTS = ['binary_sensor', 'sensor', 'switch', 'light']
+
+# Model registry. Every model maps to the entities created for it; kind
+# selects the entity class within the platform of component.
+XiaomiEntitySpec = namedtuple('XiaomiEntitySpec', ['component', 'kind', 'name', 'data_key'])
+
+MODELS = {
+    'sensor_ht': (XiaomiEntitySpec('sensor', 'sensor', 'Temperature', 'temperature'),
+                  XiaomiEntitySpec('sensor', 'sensor', 'Humidity', 'humidity')),
+    'gateway': (XiaomiEntitySpec('sensor', 'sensor', 'Illuminance', 'illumination'),
+                XiaomiEntitySpec('light', 'light', 'Gateway Light', 'rgb')),
+    'magnet': (XiaomiEntitySpec('binary_sensor', 'door', 'Door Window Sensor', 'status'),),
+    'motion': (XiaomiEntitySpec('binary_sensor', 'motion', 'Motion Sensor', 'status'),),
+    'switch': (XiaomiEntitySpec('binary_sensor', 'button', 'Switch', 'status'),),
+    '86sw1': (XiaomiEntitySpec('binary_sensor', 'button', 'Wall Switch', 'channel_0'),),
+    '86sw2': (XiaomiEntitySpec('binary_sensor', 'button', 'Wall Switch (Left)', 'channel_0'),
+              XiaomiEntitySpec('binary_sensor', 'button', 'Wall Switch (Right)', 'channel_1')),
+    'cube': (XiaomiEntitySpec('binary_sensor', 'cube', 'Cube', 'status'),),
+    'smoke': (XiaomiEntitySpec('binary_sensor', 'smoke', 'Smoke Sensor', 'alarm'),),
+    'natgas': (XiaomiEntitySpec('binary_sensor', 'gas', 'Natural Gas Sensor', 'alarm'),),
+    'plug': (XiaomiEntitySpec('switch', 'switch', 'Plug', 'status'),),
+    'ctrl_neutral1': (XiaomiEntitySpec('switch', 'switch', 'Wall Switch', 'channel_0'),),
+    'ctrl_neutral2': (XiaomiEntitySpec('switch', 'switch', 'Wall Switch Left', 'channel_0'),
+                      XiaomiEntitySpec('switch', 'switch', 'Wall Switch Right', 'channel_1')),
+    '86plug': (XiaomiEntitySpec('switch', 'switch', 'Wall Plug', 'status'),),
+}
+
+# Components that can only be controlled with the gateway key
+KEYED_COMPONENTS = ('switch', 'light')
+
+def _compile_models(models):
+    """Index the registry by model and by (model, component)."""
+    components = {}
+    entities = {}
+    for model, specs in models.items():
+        components[model] = tuple(OrderedDict.fromkeys(spec.component for spec in specs))
+        for spec in specs:
+            entities.setdefault((model, spec.component), []).append(spec)
+    return components, entities
+
+MODEL_COMPONENTS, MODEL_ENTITIES = _compile_models(MODELS)
+
+def model_entities(model, component):
+    """Return the entity specs of model that belong to component."""
+    return MODEL_ENTITIES.get((model, component), ())
+
+# Report keys that announce an event rather than a state, and the entity
+# kinds whose data key does. They are not cached, as restoring them would
+# hide the real state or replay the event.
+EVENT_KEYS = ('no_close', 'no_motion', 'rotate')
+EVENT_KINDS = ('button', 'cube')
+
+MODEL_EVENT_KEYS = {model: frozenset(EVENT_KEYS + tuple(spec.data_key for spec in specs
+                                                        if spec.kind in EVENT_KINDS))
+                    for model, specs in MODELS.items()}
+
+def state_data(model, data):
+    """Return data without the keys of model that only announce events."""
+    event_keys = MODEL_EVENT_KEYS.get(model, EVENT_KEYS)
+    return {key: value for key, value in data.items() if key not in event_keys}
+
+INVENTORY_FILE = '.xiaomi_devices.json'
+SIGNAL_NEW_DEVICE = 'xiaomi_new_device_{}'
+PY_XIAOMI_GATEWAY = None
+
+# Shortcut for the logger
+_LOGGER = logging.getLogger(__name__)
+
+ATTR_RINGTONE_ID = 'ringtone_id'
+ATTR_RINGTONE_VOL = 'ringtone_vol'
+ATTR_GW_SID = 'gw_sid'
+ATTR_STATE = 'state'
+ATTR_FILE = 'file'
+ATTR_SPEED = 'speed'
+ATTR_UNVERIFIED = 'unverified'
+
+VOLTAGE = 'voltage'
+
+XiaomiMessage = namedtuple('XiaomiMessage', ['cmd', 'model', 'sid', 'short_id', 'token', 'data'])
+
+
+def decode_message(raw):
+    """Decode a gateway datagram into a XiaomiMessage.
+
+    The nested data string is parsed here, once, so nothing downstream has
+    to touch JSON again. Raises ValueError for malformed datagrams.
+    """
+    msg = json.loads(raw.decode())
+    if not isinstance(msg, dict):
+        raise ValueError('Datagram is not a JSON object')
+    data = msg.get('data')
+    if isinstance(data, str):
+        data = json.loads(data)
+    return XiaomiMessage(msg.get('cmd'), msg.get('model'), msg.get('sid'),
+                         msg.get('short_id'), msg.get('token'), data)
+
+def derive_key(cipher, token):
+    """Return the write key for token, given an AES ECB cipher of the gateway key.
+
+    The token is a single AES block, so CBC encryption with the fixed IV
+    is ECB encryption of token ^ IV. That lets one ECB cipher per
+    gateway be reused for every token.
+    """
+    block = int.from_bytes(token.encode(), 'big') ^ KEY_INIT_VECTOR
+    return binascii.hexlify(cipher.encrypt(block.to_bytes(16, 'big'))).decode()
+
+def backoff(base, attempt, ceiling):
+    """Return base doubled attempt times with up to 25% jitter, capped at ceiling."""
+    return min(base * 2 ** attempt * random.uniform(1.0, 1.25), ceiling)
+
+def setup(hass, config):
+    """Set up the Xiaomi component."""
+
+    hass.data[DOMAIN] = {}
+    hass.data[DOMAIN]['poll_motion'] = config[DOMAIN][CONF_POLL_MOTION]
+    hass.data[DOMAIN]['power_deadband'] = config[DOMAIN][CONF_POWER_DEADBAND]
+    hass.data[DOMAIN]['power_interval'] = config[DOMAIN][CONF_POWER_INTERVAL]
+    hass.data[DOMAIN]['stats'] = config[DOMAIN][CONF_STATS]
+    hass.data[DOMAIN]['command_timeout'] = config[DOMAIN][CONF_COMMAND_TIMEOUT]
+    hass.data[DOMAIN]['command_retries'] = config[DOMAIN][CONF_COMMAND_RETRIES]
+    hass.data[DOMAIN]['optimistic'] = config[DOMAIN][CONF_OPTIMISTIC]
+    hass.data[DOMAIN]['stale_after'] = dict(STALE_AFTER, **config[DOMAIN][CONF_STALE_AFTER])
+    hass.data[DOMAIN]['workers'] = config[DOMAIN][CONF_WORKERS]
+
+    gateways = config[DOMAIN][CONF_GATEWAYS]
+    interface = config[DOMAIN][CONF_INTERFACE]
+    discovery_retry = config[DOMAIN][CONF_DISCOVERY_RETRY]
+
+    for gateway in gateways:
+        sid = gateway['sid']
+
+        if sid != None:
+            gateway['sid'] = gateway['sid'].replace(":", "").lower()
+
+        key = gateway['key']
+        if key == DEFAULT_KEY:
+            _LOGGER.warning('Gateway Key is not provided. Only sensors will be loaded.')
+
+        if len(key) != 16:
+            _LOGGER.error('Invalid key %s. Key must be 16 characters', key)
+            return False
+
+    global PY_XIAOMI_GATEWAY
+    PY_XIAOMI_GATEWAY = PyXiaomiGateway(hass, gateways, interface)
+
+    if CONF_CAPTURE in config[DOMAIN]:
+        PY_XIAOMI_GATEWAY.capture.open(hass.config.path(config[DOMAIN][CONF_CAPTURE]))
+
+    inventory_path = hass.config.path(INVENTORY_FILE)
+    PY_XIAOMI_GATEWAY.load_inventory(inventory_path)
+
+    _LOGGER.info("Expecting %s gateways", len(gateways))
+    for _ in range(discovery_retry):
+        _LOGGER.info('Discovering Xiaomi Gateways (Try %s)', _ + 1)
+        PY_XIAOMI_GATEWAY.discover_gateways(
+            backoff(1.0, _, PyXiaomiGateway.GATEWAY_DISCOVERY_TIMEOUT))
+        if PY_XIAOMI_GATEWAY.all_gateways_found():
+            break
+
+    if len(PY_XIAOMI_GATEWAY.gateways) == 0:
+        _LOGGER.error("No gateway discovered")
+        return False
+
+    PY_XIAOMI_GATEWAY.connect_gateways()
+
+    PY_XIAOMI_GATEWAY.listen()
+    _LOGGER.info("Listening for broadcast")
+
+    @callback
+    def reconcile_devices(event):
+        """Read new devices and refresh the cached ones."""
+        hass.async_add_job(PY_XIAOMI_GATEWAY.async_reconcile_devices())
+
+    def stop_xiaomi(event):
+        """Stop Xiaomi Socket."""
+        _LOGGER.info("Shutting down Xiaomi Hub.")
+        PY_XIAOMI_GATEWAY.save_inventory(inventory_path)
+        PY_XIAOMI_GATEWAY.stop_listen()
+
+    hass.bus.listen_once(EVENT_HOMEASSISTANT_START, reconcile_devices)
+    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, stop_xiaomi)
+
+    for component in XIAOMI_COMPONENTS:
+        discovery.load_platform(hass, component, DOMAIN, {}, config)
+
+
+    def play_ringtone_service(call):
+        """Service to play ringtone through Gateway."""
+        if call.data.get(ATTR_RINGTONE_ID) is None:
+            _LOGGER.error("Mandatory parameters is not specified.")
+            return
+        if (len(PY_XIAOMI_GATEWAY.gateways) != 1) and call.data.get(ATTR_GW_SID) is None:
+            _LOGGER.error("Mandatory parameters is not specified.")
+            return
+
+        ring_id = int(call.data.get(ATTR_RINGTONE_ID))
+
+        if ring_id in [9, 14-19]:
+            _LOGGER.error('Specified mid: %s is not defined in gateway.', mid)
+            return
+
+        ring_vol = call.data.get(ATTR_RINGTONE_VOL)
+        if ring_vol is None:
+            ringtone = {'mid': ring_id}
+        else:
+            ringtone = {'mid': ring_id, 'vol': int(ring_vol)}
+
+        gw_sid = call.data.get(ATTR_GW_SID)
+
+        gateways = PY_XIAOMI_GATEWAY.gateways
+        for (ip_add, gateway) in gateways.items():
+            if len(gateways) == 1:
+                gateway.write_to_hub_multi(gateway.sid, **ringtone)
+                break
+            elif gateway.sid == gw_sid:
+                gateway.write_to_hub_multi(gateway.sid, **ringtone)
+                break
+        else:
+            _LOGGER.error('Unknown gateway sid: %s was specified.', gw_sid)
+
+    def stop_ringtone_service(call):
+        """Service to stop playing ringtone on Gateway."""
+        if (len(PY_XIAOMI_GATEWAY.gateways) != 1) and call.data.get(ATTR_GW_SID) is None:
+            _LOGGER.error("Mandatory parameters is not specified.")
+            return
+
+        gw_sid = call.data.get(ATTR_GW_SID)
+
+        gateways = PY_XIAOMI_GATEWAY.gateways
+        for (ip_add, gateway) in gateways.items():
+            if len(gateways) == 1:
+                gateway.write_to_hub(gateway.sid, 'mid', 10000)
+                break
+            elif gateway.sid == gw_sid:
+                gateway.write_to_hub(gateway.sid, 'mid', 10000)
+                break
+        else:
+            _LOGGER.error('Unknown gateway sid: %s was specified.', gw_sid)
+
+    @asyncio.coroutine
+    def write_many_service(call):
+        """Service to switch many devices with one batch per gateway."""
+        entity_ids = call.data.get(ATTR_ENTITY_ID)
+        if entity_ids is None or call.data.get(ATTR_STATE) is None:
+            _LOGGER.error("Mandatory parameters is not specified.")
+            return
+        entity_ids = cv.entity_ids(entity_ids)
+        state = cv.boolean(call.data.get(ATTR_STATE))
+
+        batches = []
+        for gateway in PY_XIAOMI_GATEWAY.gateways.values():
+            entities = []
+            writes = []
+            for device in gateway.ha_devices:
+                if device.entity_id not in entity_ids:
+                    continue
+                data = device.command_data(state)
+                if data is None:
+                    _LOGGER.error('%s cannot be switched', device.entity_id)
+                    continue
+                entities.append(device)
+                writes.append((device.sid, data))
+            if writes:
+                batches.append((gateway, entities, writes))
+
+        @asyncio.coroutine
+        def write_batch(gateway, entities, writes, acks):
+            """Write one gateway's batch and hand every entity its ack."""
+            results = [False] * len(writes)
+            try:
+                results = yield from gateway.async_write_to_hub_many(writes)
+            finally:
+                for device, ack, result in zip(entities, acks, results):
+                    if not result:
+                        _LOGGER.error('Cannot switch %s', device.entity_id)
+                    ack.set_result(result)
+
+        jobs = []
+        for gateway, entities, writes in batches:
+            acks = [asyncio.Future(loop=hass.loop) for _ in entities]
+            jobs.extend(device.async_apply_command(state, ack)
+                        for device, ack in zip(entities, acks))
+            jobs.append(write_batch(gateway, entities, writes, acks))
+        yield from asyncio.gather(*jobs, loop=hass.loop)
+
+    @callback
+    def dump_stats_service(call):
+        """Service to log the message pipeline statistics."""
+        stats = PY_XIAOMI_GATEWAY.stats.as_dict()
+        stats['rtt'] = {gateway.sid: {rtn_cmd: estimator.as_dict()
+                                      for rtn_cmd, estimator in gateway.rtt.items()}
+                        for gateway in PY_XIAOMI_GATEWAY.gateways.values()}
+        _LOGGER.info('Xiaomi statistics: %s', json.dumps(stats, sort_keys=True))
+        hass.bus.async_fire('xiaomi_stats', stats)
+
+    @asyncio.coroutine
+    def replay_capture_service(call):
+        """Service to replay a capture file through the dispatch path."""
+        if call.data.get(ATTR_FILE) is None:
+            _LOGGER.error("Mandatory parameters is not specified.")
+            return
+        speed = float(call.data.get(ATTR_SPEED, 1))
+        yield from PY_XIAOMI_GATEWAY.async_replay(hass.config.path(call.data[ATTR_FILE]), speed)
+
+    hass.services.async_register(DOMAIN, 'play_ringtone', play_ringtone_service, description=None, schema=None)
+    hass.services.async_register(DOMAIN, 'stop_ringtone', stop_ringtone_service, description=None, schema=None)
+    hass.services.async_register(DOMAIN, 'write_many', write_many_service, description=None, schema=None)
+    hass.services.async_register(DOMAIN, 'dump_stats', dump_stats_service, description=None, schema=None)
+    hass.services.async_register(DOMAIN, 'replay_capture', replay_capture_service, description=None, schema=None)
+
+    return True
+
+
+class PyXiaomiGateway:
+    """PyXiami."""
+    MULTICAST_ADDRESS = '224.0.0.50'
+    MULTICAST_PORT = 9898
+    GATEWAY_DISCOVERY_PORT = 4321
+    GATEWAY_DISCOVERY_TIMEOUT = 5.0
+    SOCKET_BUFSIZE = 1024
+
+    def __init__(self, hass, gateways_config, interface):
+
+        self.hass = hass
+        self.gateways = {}
+        self.dispatcher = XiaomiDispatcher()
+        self.stats = XiaomiStats()
+        self.capture = XiaomiCapture()
+        self.events = XiaomiEventEmitter(hass)
+        self.timers = XiaomiTimerWheel(hass)
+        self._inventory = {}
+        self.health_monitor = XiaomiHealthMonitor(hass, self)
+        self._listening = False
+        self._mcastsocket = None
+        self._mcast_transport = None
+        self._shards = None
+        self._workers = hass.data.get(DOMAIN, {}).get('workers', 0)
+        self._gateways_config = gateways_config
+        self._interface = interface
+
+    def _create_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self._interface != 'any':
+            sock.bind((self._interface, 0))
+        return sock
+
+    def all_gateways_found(self):
+        """Return True once every configured gateway has answered."""
+        found = [gateway.sid for gateway in self.gateways.values()]
+        for gateway in self._gateways_config:
+            if gateway['sid'] is not None and gateway['sid'] not in found:
+                return False
+        return len(found) >= len(self._gateways_config)
+
+    def discover_gateways(self, timeout=None):
+        """Discover gateways using multicast"""
+        if timeout is None:
+            timeout = self.GATEWAY_DISCOVERY_TIMEOUT
+
+        _socket = self._create_socket()
+        start = time.monotonic()
+
+        try:
+            _socket.sendto('{"cmd":"whois"}'.encode(),
+                           (self.MULTICAST_ADDRESS, self.GATEWAY_DISCOVERY_PORT))
+
+            deadline = start + timeout
+
+            while not self.all_gateways_found():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout()
+                _socket.settimeout(remaining)
+                data, addr = _socket.recvfrom(1024)
+                if len(data) is None:
+                    continue
+
+                resp = json.loads(data.decode())
+                if resp["cmd"] != 'iam':
+                    _LOGGER.error("Response does not match return cmd")
+                    continue
+
+                if resp["model"] != 'gateway':
+                    _LOGGER.error("Response must be gateway model")
+                    continue
+
+                ip_add = resp["ip"]
+                if ip_add in self.gateways:
+                    continue
+
+                gateway_key = ''
+                for gateway in self._gateways_config:
+                    sid = gateway['sid']
+                    key = gateway['key']
+                    if sid is None or sid == resp["sid"]:
+                        gateway_key = key
+
+                sid = resp["sid"]
+                port = resp["port"]
+
+                #Info to fill in API key in Configuration.xml
+                if gateway_key == DEFAULT_KEY:
+                    _LOGGER.warning('To enable discovery of switches, fill in API key in configuration.xml sid = %s', sid)
+
+                _LOGGER.info('Xiaomi Gateway %s found at IP %s', sid, ip_add)
+
+                self.add_gateway(ip_add, port, sid, gateway_key)
+
+        except socket.timeout:
+            _LOGGER.info("Gateway finding finished in %.1f seconds", time.monotonic() - start)
+        finally:
+            _socket.close()
+
+    def whois(self, sids, timeout):
+        """Return {sid: (ip, port)} of the gateways in sids that answer a whois."""
+        found = {}
+        _socket = self._create_socket()
+        try:
+            _socket.sendto('{"cmd":"whois"}'.encode(),
+                           (self.MULTICAST_ADDRESS, self.GATEWAY_DISCOVERY_PORT))
+            deadline = time.monotonic() + timeout
+            while not set(sids) <= set(found):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                _socket.settimeout(remaining)
+                data, _ = _socket.recvfrom(self.SOCKET_BUFSIZE)
+                resp = json.loads(data.decode())
+                if resp.get("cmd") == 'iam' and resp.get("sid") in sids:
+                    found[resp["sid"]] = (resp["ip"], resp["port"])
+        except socket.timeout:
+            pass
+        except (OSError, ValueError, KeyError) as err:
+            _LOGGER.error('Gateway whois failed: %s', err)
+        finally:
+            _socket.close()
+        return found
+
+    @callback
+    def move_gateway(self, sid, ip_add, port=None):
+        """Point the gateway sid at a new address and return it."""
+        for gateway in self.gateways.values():
+            if gateway.sid == sid:
+                break
+        else:
+            return None
+        if port is not None:
+            gateway.port = int(port)
+        if gateway.ip_add != ip_add:
+            _LOGGER.warning('Xiaomi Gateway %s moved from %s to %s', sid, gateway.ip_add, ip_add)
+            gateways = {ip: other for ip, other in self.gateways.items() if other is not gateway}
+            gateway.ip_add = ip_add
+            gateways[ip_add] = gateway
+            self.gateways = gateways
+        return gateway
+
+    def add_gateway(self, ip_add, port, sid, key):
+        """Register a gateway found at ip_add."""
+        gateway = XiaomiGateway(self.hass, ip_add, port, sid, key, self._create_socket(),
+                                self.dispatcher, self.stats, self.capture, self.events,
+                                self.timers)
+        self.gateways[ip_add] = gateway
+        return gateway
+
+    def connect_gateways(self):
+        """Connect every gateway and load its cached devices."""
+        asyncio.run_coroutine_threadsafe(
+            self.async_connect_gateways(), self.hass.loop).result()
+
+    @asyncio.coroutine
+    def async_connect_gateways(self):
+        """Connect every gateway and load its cached devices."""
+        for gateway in self.gateways.values():
+            yield from gateway.async_connect()
+            cached = self._inventory.get(gateway.sid)
+            if cached is not None:
+                _LOGGER.info('Loaded %s cached devices for gateway %s',
+                             len(cached['devices']), gateway.sid)
+                gateway.load_inventory(cached['devices'])
+
+    def discover_devices(self):
+        """Enumerate the devices of all gateways concurrently."""
+        asyncio.run_coroutine_threadsafe(
+            self.async_discover_devices(), self.hass.loop).result()
+
+    @asyncio.coroutine
+    def async_discover_devices(self, announce=False):
+        """Enumerate the devices of all gateways concurrently."""
+        yield from asyncio.gather(*[gateway.async_discover_devices(announce)
+                                    for gateway in self.gateways.values()],
+                                  loop=self.hass.loop)
+
+    @asyncio.coroutine
+    def async_reconcile_devices(self):
+        """Announce the devices missing from the inventory, then refresh the cached ones."""
+        yield from self.async_discover_devices(announce=True)
+        yield from asyncio.gather(*[gateway.async_verify_devices()
+                                    for gateway in self.gateways.values()],
+                                  loop=self.hass.loop)
+
+    def load_inventory(self, path):
+        """Load the device inventory cached by save_inventory."""
+        try:
+            with open(path) as inventory:
+                self._inventory = json.load(inventory)
+        except FileNotFoundError:
+            self._inventory = {}
+        except (OSError, ValueError) as err:
+            _LOGGER.error('Cannot load device inventory %s: %s', path, err)
+            self._inventory = {}
+
+    def save_inventory(self, path):
+        """Persist the device inventory of every gateway to path."""
+        inventory = asyncio.run_coroutine_threadsafe(
+            self._async_inventory(), self.hass.loop).result()
+        try:
+            with open(path, 'w') as inventory_file:
+                json.dump(inventory, inventory_file)
+        except OSError as err:
+            _LOGGER.error('Cannot save device inventory %s: %s', path, err)
+
+    @asyncio.coroutine
+    def _async_inventory(self):
+        inventory = dict(self._inventory)
+        for gateway in self.gateways.values():
+            inventory[gateway.sid] = {
+                'ip': gateway.ip_add,
+                'port': gateway.port,
+                'devices': copy.deepcopy(list(gateway.inventory.values()))
+            }
+        return inventory
+
+    @classmethod
+    def create_mcast_socket(cls, interface):
+        """Return a socket joined to the gateway multicast group."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if interface != 'any':
+            if platform.system() != "Windows":
+                sock.bind((cls.MULTICAST_ADDRESS, cls.MULTICAST_PORT))
+            else:
+                sock.bind((interface, cls.MULTICAST_PORT))
+
+            mreq = socket.inet_aton(cls.MULTICAST_ADDRESS) + socket.inet_aton(interface)
+        else:
+            sock.bind((cls.MULTICAST_ADDRESS, cls.MULTICAST_PORT))
+            mreq = struct.pack("4sl", socket.inet_aton(cls.MULTICAST_ADDRESS), socket.INADDR_ANY)
+
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        return sock
+
+    def listen(self):
+        """Start listening."""
+        asyncio.run_coroutine_threadsafe(self.async_listen(), self.hass.loop).result()
+
+    @asyncio.coroutine
+    def async_listen(self):
+        """Start listening on the event loop."""
+        if self._workers:
+            _LOGGER.info('Starting %s multicast listener processes', self._workers)
+            keys = {gateway.sid: gateway.key for gateway in self.gateways.values()
+                    if gateway.key and gateway.key != DEFAULT_KEY}
+            self._shards = XiaomiShards(self._workers, self._interface, keys,
+                                        self.capture.capturing)
+            yield from self.hass.loop.run_in_executor(None, self._shards.start)
+            self._shards.async_attach(self.hass.loop, self._handle_shard_msg)
+        else:
+            _LOGGER.info('Creating Multicast Socket')
+            self._mcastsocket = self.create_mcast_socket(self._interface)
+            self._mcast_transport, _ = yield from self.hass.loop.create_datagram_endpoint(
+                lambda: XiaomiMulticastProtocol(self._handle_mcast_msg), sock=self._mcastsocket)
+        self._listening = True
+        self.health_monitor.async_start()
+
+    def stop_listen(self):
+        """Stop listening."""
+        self._listening = False
+        self.health_monitor.stop()
+
+        _LOGGER.info('Closing socket')
+        for gateway in self.gateways.values():
+            gateway.close()
+
+        if self._mcast_transport is not None:
+            _LOGGER.info('Closing multisocket')
+            self.hass.loop.call_soon_threadsafe(self._mcast_transport.close)
+            self._mcast_transport = None
+            self._mcastsocket = None
+
+        if self._shards is not None:
+            _LOGGER.info('Stopping multicast listener processes')
+            self._shards.stop(self.hass.loop)
+            self._shards = None
+
+        self.hass.loop.call_soon_threadsafe(self.capture.close)
+
+    @asyncio.coroutine
+    def async_replay(self, path, speed=1.0, stats=None):
+        """Feed the multicast datagrams of a capture file through the handler.
+
+        Datagrams are replayed speed times faster than they were captured,
+        or as fast as possible if speed is 0. Returns the number replayed.
+        They are not captured again and are counted in stats, a fresh
+        XiaomiStats by default, instead of the live statistics. They only
+        reach the entities: gateway keys, addresses and availability are
+        left alone.
+        """
+        if stats is None:
+            stats = XiaomiStats()
+        records = yield from self.hass.loop.run_in_executor(None, read_capture, path)
+        start = self.hass.loop.time()
+        first = None
+        count = 0
+        for timestamp, kind, addr, data in records:
+            if kind != 'mcast':
+                continue
+            if first is None:
+                first = timestamp
+            if speed:
+                delay = start + (timestamp - first) / speed - self.hass.loop.time()
+                if delay > 0:
+                    yield from asyncio.sleep(delay, loop=self.hass.loop)
+            elif count % 256 == 0:
+                # Let the rest of Home Assistant run during a long replay
+                yield from asyncio.sleep(0, loop=self.hass.loop)
+            count += 1
+            received = time.monotonic()
+            try:
+                msg = decode_message(data)
+            except ValueError:
+                stats.decode_errors += 1
+                continue
+            self._handle_msg(msg, addr[0], received, stats, replay=True)
+        _LOGGER.info('Replayed %s datagrams from %s in %.1f seconds',
+                     count, path, self.hass.loop.time() - start)
+        return count
+
+    @callback
+    def _handle_mcast_msg(self, data, addr):
+        received = time.monotonic()
+        self.capture.record('mcast', addr, data)
+        try:
+            msg = decode_message(data)
+        except ValueError:
+            self.stats.decode_errors += 1
+            _LOGGER.error('Cannot decode multicast message : %s', data)
+            return
+        self._handle_msg(msg, addr[0], received)
+
+    @callback
+    def _handle_shard_msg(self, addr, fields, write_key, data):
+        received = time.monotonic()
+        if data is not None:
+            self.capture.record('mcast', addr, data)
+        if fields is None:
+            self.stats.decode_errors += 1
+            return
+        msg = XiaomiMessage(*fields)
+        self._handle_msg(msg, addr[0], received)
+        gateway = self.gateways.get(addr[0])
+        if write_key is not None and gateway is not None and gateway.sid == msg.sid:
+            gateway.update_key(msg.token, write_key)
+
+    @callback
+    def _handle_msg(self, msg, ip_add, received, stats=None, replay=False):
+        if stats is None:
+            stats = self.stats
+        try:
+            gateway = self.gateways.get(ip_add)
+            if (gateway is None and not replay and
+                    msg.cmd == 'heartbeat' and msg.model == 'gateway'):
+                gateway = self.move_gateway(msg.sid, ip_add)
+            if gateway is None:
+                stats.unknown_gateway += 1
+                _LOGGER.error('Unknown gateway ip %s', ip_add)
+                return
+
+            if not replay:
+                gateway.last_seen = received
+                if not gateway.available:
+                    gateway.set_available(True)
+            stats.packets[gateway.sid] += 1
+            stats.models[msg.model or 'unknown'] += 1
+            cmd = msg.cmd
+            if cmd == 'heartbeat' and msg.model == 'gateway':
+                if not replay:
+                    gateway.update_key(msg.token)
+            elif cmd == 'report' or cmd == 'heartbeat':
+                _LOGGER.debug('MCAST (%s) << %s', cmd, msg)
+                if replay:
+                    if msg.data is not None:
+                        self.dispatcher.dispatch(gateway.sid, msg.sid, msg.data)
+                else:
+                    gateway.push_data(msg)
+                stats.dispatch.add(time.monotonic() - received)
+
+            else:
+                _LOGGER.error('Unknown multicast data : %s', msg)
+        except Exception:
+            _LOGGER.error('Cannot process multicast message : %s', msg)
+
+class XiaomiShards:
+    """Multicast listener split across worker processes.
+
+    One receiver process reads the multicast group once and hands each
+    datagram to the decoder process its gateway IP hashes to. A decoder
+    parses the datagrams of its gateways, derives the write key from every
+    gateway heartbeat and sends the message fields through a pipe. The Home
+    Assistant process still unpickles every message, which saves the JSON
+    parsing and the AES work but not a per-message cost. If any process
+    exits, all of them are restarted after RESTART_DELAY seconds.
+    """
+    RESTART_DELAY = 5
+
+    def __init__(self, count, interface, keys, capture):
+        self._count = count
+        self._interface = interface
+        self._keys = keys
+        self._capture = capture
+        self._processes = []
+        self._readers = []
+        self._stopped = False
+        self._restarting = False
+
+    def start(self):
+        """Start the receiver and decoder processes."""
+        context = multiprocessing.get_context('spawn')
+        sources = []
+        for index in range(self._count):
+            source, source_writer = context.Pipe(duplex=False)
+            reader, writer = context.Pipe(duplex=False)
+            process = context.Process(
+                target=_run_shard, args=(source, writer, self._keys, self._capture),
+                name='xiaomi-shard-{}'.format(index), daemon=True)
+            process.start()
+            source.close()
+            writer.close()
+            sources.append(source_writer)
+            self._processes.append(process)
+            self._readers.append(reader)
+        receiver = context.Process(target=_run_receiver, args=(sources, self._interface),
+                                   name='xiaomi-receiver', daemon=True)
+        receiver.start()
+        for source_writer in sources:
+            source_writer.close()
+        self._processes.append(receiver)
+
+    @callback
+    def async_attach(self, loop, handler):
+        """Call handler(addr, fields, key, data) on the loop for every message."""
+        for reader in self._readers:
+            loop.add_reader(reader.fileno(), self._read, loop, reader, handler)
+
+    def stop(self, loop):
+        """Stop the worker processes. Safe to call from any thread."""
+        self._stopped = True
+        loop.call_soon_threadsafe(self._async_stop, loop)
+
+    @callback
+    def _async_stop(self, loop):
+        for reader in self._readers:
+            loop.remove_reader(reader.fileno())
+            reader.close()
+        for process in self._processes:
+            process.terminate()
+        self._readers = []
+        self._processes = []
+
+    @callback
+    def _read(self, loop, reader, handler):
+        try:
+            while reader.poll():
+                handler(*reader.recv())
+        except (EOFError, OSError):
+            if self._stopped or self._restarting:
+                return
+            _LOGGER.error('A multicast listener process exited, restarting them in %s seconds',
+                          self.RESTART_DELAY)
+            self._restarting = True
+            self._async_stop(loop)
+            loop.create_task(self._async_restart(loop, handler))
+
+    @asyncio.coroutine
+    def _async_restart(self, loop, handler):
+        yield from asyncio.sleep(self.RESTART_DELAY, loop=loop)
+        self._restarting = False
+        if self._stopped:
+            return
+        yield from loop.run_in_executor(None, self.start)
+        if self._stopped:
+            self._async_stop(loop)
+            return
+        self.async_attach(loop, handler)
+
+def _run_receiver(sinks, interface):
+    """Hand every multicast datagram to the shard of its source IP."""
+    parent = os.getppid()
+    sock = PyXiaomiGateway.create_mcast_socket(interface)
+    sock.settimeout(5)
+    while True:
+        try:
+            data, addr = sock.recvfrom(PyXiaomiGateway.SOCKET_BUFSIZE)
+        except socket.timeout:
+            if os.getppid() != parent:
+                return
+            continue
+        try:
+            sinks[zlib.crc32(addr[0].encode()) % len(sinks)].send((data, addr))
+        except OSError:
+            return
+
+def _run_shard(source, sink, keys, capture):
+    """Decode the datagrams of one shard and derive the gateways' write keys.
+
+    keys maps gateway sids to their configured keys. Every message goes
+    out as (addr, fields, write key or None, datagram if capture).
+    """
+    ciphers = {}
+    while True:
+        try:
+            data, addr = source.recv()
+        except EOFError:
+            return
+        raw = data if capture else None
+        fields = None
+        write_key = None
+        # A stray datagram on the group must never take the shard down
+        try:
+            msg = decode_message(data)
+            fields = tuple(msg)
+            if (msg.cmd == 'heartbeat' and msg.model == 'gateway' and
+                    msg.sid in keys and msg.token is not None):
+                if msg.sid not in ciphers:
+                    from Crypto.Cipher import AES
+                    ciphers[msg.sid] = AES.new(keys[msg.sid].encode(), AES.MODE_ECB)
+                write_key = derive_key(ciphers[msg.sid], msg.token)
+        except Exception:
+            pass
+        try:
+            sink.send((addr, fields, write_key, raw))
+        except OSError:
+            return
+
+class XiaomiMulticastProtocol(asyncio.DatagramProtocol):
+    """Receive gateway reports on the event loop."""
+
+    def __init__(self, handler):
+        self._handler = handler
+
+    def datagram_received(self, data, addr):
+        """Hand a received datagram to the handler."""
+        self._handler(data, addr)
+
+    def error_received(self, exc):
+        """Log socket errors reported by the transport."""
+        _LOGGER.error('Multicast socket error: %s', exc)
+
+class XiaomiHistogram:
+    """Latency histogram with fixed millisecond buckets."""
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Record one sample given in seconds."""
+        value = seconds * 1000
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket holding the fraction-th sample."""
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, hits in zip(self.BOUNDS, self.buckets):
+            seen += hits
+            if seen >= target:
+                return bound
+        return round(self.max, 1)
+
+    def as_dict(self):
+        """Return a summary of the histogram."""
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 2) if self.count else None,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'max': round(self.max, 1),
+        }
+
+class XiaomiStats:
+    """Counters and latency histograms for the gateway message pipeline.
+
+    dispatch measures from the event loop handing a datagram to the
+    component until push_data returns. Time spent in the socket buffer and
+    the loop queue before that is not included.
+    """
+
+    def __init__(self):
+        self.packets = Counter()
+        self.models = Counter()
+        self.timeouts = Counter()
+        self.decode_errors = 0
+        self.unknown_gateway = 0
+        self.dispatch = XiaomiHistogram()
+        self.ack_rtt = XiaomiHistogram()
+
+    def as_dict(self):
+        """Return all counters and histogram summaries."""
+        return {
+            'packets': dict(self.packets),
+            'models': dict(self.models),
+            'timeouts': dict(self.timeouts),
+            'decode_errors': self.decode_errors,
+            'unknown_gateway': self.unknown_gateway,
+            'dispatch_ms': self.dispatch.as_dict(),
+            'ack_rtt_ms': self.ack_rtt.as_dict(),
+        }
+
+class XiaomiRttEstimator:
+    """Smoothed round trip time and retransmission timeout of one reply type.
+
+    Follows RFC 6298: SRTT and RTTVAR are updated from every unambiguous
+    sample and the timeout is SRTT + 4 * RTTVAR, within the 1 second floor
+    and the configured ceiling. Before the first sample the timeout is 1
+    second, and a timeout doubles it until the next sample (section 5.5).
+    """
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+    INITIAL_TIMEOUT = 1.0
+    MIN_TIMEOUT = 1.0
+
+    def __init__(self, max_timeout):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = min(self.INITIAL_TIMEOUT, max_timeout)
+        self.max_timeout = max_timeout
+
+    def add(self, rtt):
+        """Record one round trip time in seconds."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(max(self.srtt + self.K * self.rttvar, self.MIN_TIMEOUT),
+                       self.max_timeout)
+
+    def timed_out(self, rto):
+        """Back off the timeout after a command sent with timeout rto went unanswered.
+
+        Commands sent together with the same timeout back it off only once.
+        """
+        if self.rto <= rto:
+            self.rto = min(rto * 2, self.max_timeout)
+
+    def timeout(self, attempt=0):
+        """Return the timeout for the attempt-th send of a command."""
+        return backoff(self.rto, attempt, self.max_timeout)
+
+    def as_dict(self):
+        """Return the estimator state in milliseconds."""
+        return {
+            'srtt': None if self.srtt is None else round(self.srtt * 1000, 1),
+            'rttvar': None if self.rttvar is None else round(self.rttvar * 1000, 1),
+            'rto': round(self.rto * 1000, 1),
+        }
+
+class XiaomiDispatcher:
+    """Index of the entities consuming each (gateway, sid, data key).
+
+    Lookups never insert, and a sid's entry is replaced by a new tuple-valued
+    dict whenever an entity registers, so dispatch only reads data that is
+    never mutated in place.
+    """
+
+    def __init__(self):
+        self._index = {}
+
+    def register(self, gateway_sid, sid, data_keys, entity):
+        """Register entity for the given data keys of sid."""
+        index_key = (gateway_sid, sid)
+        by_key = dict(self._index.get(index_key, {}))
+        for data_key in data_keys:
+            by_key[data_key] = by_key.get(data_key, ()) + (entity,)
+        self._index[index_key] = by_key
+
+    def unregister(self, gateway_sid, sid):
+        """Stop routing the reports of sid to any entity."""
+        self._index.pop((gateway_sid, sid), None)
+
+    def dispatch(self, gateway_sid, sid, data):
+        """Push data to the entities consuming any of its keys."""
+        by_key = self._index.get((gateway_sid, sid))
+        if by_key is None:
+            return False
+        targets = []
+        for data_key in data:
+            for entity in by_key.get(data_key, ()):
+                if entity not in targets:
+                    targets.append(entity)
+        for entity in targets:
+            entity.push_data(data)
+        return True
+
+class XiaomiCapture:
+    """Append every gateway datagram to a newline-delimited capture file.
+
+    Each line holds the receive time, the direction (mcast, recv or send),
+    the peer ip and port and the datagram itself.
+    """
+
+    def __init__(self):
+        self._file = None
+
+    def open(self, path):
+        """Start appending to path."""
+        _LOGGER.info('Capturing gateway traffic to %s', path)
+        self._file = open(path, 'a')
+
+    @property
+    def capturing(self):
+        """Return True if datagrams are being written to a file."""
+        return self._file is not None
+
+    def close(self):
+        """Stop capturing."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def record(self, kind, addr, data):
+        """Append one datagram if capturing."""
+        if self._file is None:
+            return
+        payload = data.decode(errors='replace').replace('\n', ' ')
+        self._file.write('{:.6f} {} {} {} {}\n'.format(time.time(), kind, addr[0], addr[1], payload))
+
+def read_capture(path):
+    """Return the (timestamp, kind, addr, data) records of a capture file.
+
+    Blank or truncated lines, e.g. from a crash in the middle of a write,
+    are skipped and counted in a warning.
+    """
+    records = []
+    skipped = 0
+    with open(path) as capture:
+        for line in capture:
+            try:
+                timestamp, kind, ip_add, port, payload = line.rstrip('\n').split(' ', 4)
+                records.append((float(timestamp), kind, (ip_add, int(port)), payload.encode()))
+            except ValueError:
+                skipped += 1
+    if skipped:
+        _LOGGER.warning('Skipped %s malformed lines in %s', skipped, path)
+    return records
+
+class XiaomiCommandMux(asyncio.DatagramProtocol):
+    """Route gateway replies to the commands waiting for them.
+
+    Outstanding requests are tagged by (gateway ip, expected cmd, sid) so
+    any number of commands can be in flight on the same socket.
+    """
+
+    def __init__(self, loop, capture):
+        self._loop = loop
+        self._capture = capture
+        self._transport = None
+        self._pending = {}
+
+    def connection_made(self, transport):
+        """Store the transport once the socket is attached."""
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        """Resolve the oldest request waiting for this reply."""
+        self._capture.record('recv', addr, data)
+        try:
+            resp = decode_message(data)
+        except ValueError:
+            _LOGGER.error('Cannot decode response from %s : %s', addr[0], data)
+            return
+        _LOGGER.debug("<< %s", resp)
+
+        waiters = self._pending.get((addr[0], resp.cmd, resp.sid))
+        if not waiters:
+            waiters = self._pending.get((addr[0], resp.cmd, None))
+        if not waiters:
+            _LOGGER.debug("Unsolicited response from %s : %s", addr[0], resp)
+            return
+        waiters.popleft().set_result(resp)
+
+    def error_received(self, exc):
+        """Log socket errors reported by the transport."""
+        _LOGGER.error('Gateway socket error: %s', exc)
+
+    @asyncio.coroutine
+    def async_send(self, cmd, addr, rtn_cmd, sid, timeout):
+        """Send cmd to addr and wait for the matching reply.
+
+        Returns None if no reply arrived within timeout seconds.
+        """
+        tag = (addr[0], rtn_cmd, sid)
+        future = asyncio.Future(loop=self._loop)
+        waiters = self._pending.setdefault(tag, deque())
+        waiters.append(future)
+        _LOGGER.debug(">> %s", cmd)
+        payload = cmd.encode()
+        self._capture.record('send', addr, payload)
+        self._transport.sendto(payload, addr)
+        try:
+            return (yield from asyncio.wait_for(future, timeout, loop=self._loop))
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters and self._pending.get(tag) is waiters:
+                del self._pending[tag]
+
+    def close(self):
+        """Close the socket."""
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+class XiaomiPollScheduler:
+    """Poll the active sids of a gateway in one timed sweep.
+
+    Every POLL_INTERVAL seconds all active sids are read, each after a
+    random delay of up to POLL_JITTER seconds so the reads do not leave as
+    one burst. A sid whose previous read is still pending is skipped.
+    """
+    POLL_INTERVAL = 10
+    POLL_JITTER = 2.0
+
+    def __init__(self, hass, gateway):
+        self._hass = hass
+        self._gateway = gateway
+        self._sids = set()
+        self._in_flight = set()
+        self._handle = None
+
+    def add(self, sid):
+        """Start polling sid. Safe to call from any thread."""
+        self._hass.loop.call_soon_threadsafe(self._async_add, sid)
+
+    def discard(self, sid):
+        """Stop polling sid. Safe to call from any thread."""
+        self._hass.loop.call_soon_threadsafe(self._async_discard, sid)
+
+    def stop(self):
+        """Stop polling all sids."""
+        self._hass.loop.call_soon_threadsafe(self._async_stop)
+
+    @callback
+    def _async_add(self, sid):
+        self._sids.add(sid)
+        if self._handle is None:
+            self._handle = self._hass.loop.call_later(self.POLL_INTERVAL, self._sweep)
+
+    @callback
+    def _async_discard(self, sid):
+        self._sids.discard(sid)
+        if not self._sids:
+            self._async_stop()
+
+    @callback
+    def _async_stop(self):
+        self._sids.clear()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    @callback
+    def _sweep(self):
+        self._handle = None
+        if not self._sids:
+            return
+        for sid in self._sids - self._in_flight:
+            self._in_flight.add(sid)
+            self._hass.async_add_job(self._async_poll(sid, random.uniform(0, self.POLL_JITTER)))
+        self._handle = self._hass.loop.call_later(self.POLL_INTERVAL, self._sweep)
+
+    @asyncio.coroutine
+    def _async_poll(self, sid, delay):
+        try:
+            yield from asyncio.sleep(delay, loop=self._hass.loop)
+            if sid in self._sids:
+                yield from self._gateway.async_get_from_hub(sid)
+        finally:
+            self._in_flight.discard(sid)
+
+class XiaomiEventEmitter:
+    """Fire device events on the bus, dropping repeats inside a debounce window.
+
+    An event opens a window keyed by key, by default its type and data.
+    Further events with the same key are dropped until the window closes.
+    Given merge, the first event is held as well and every event of the
+    window is folded into one, fired when it closes. All windows share one
+    timer set for the earliest deadline.
+    """
+    WINDOW = 0.5
+
+    def __init__(self, hass):
+        self._hass = hass
+        self._open = {}
+        self._deadlines = []
+        self._counter = 0
+        self._handle = None
+        self._handle_at = None
+
+    @callback
+    def async_fire(self, event_type, data, key=None, window=None, merge=None):
+        """Fire event_type with data unless its key is inside a window."""
+        if key is None:
+            key = (event_type, tuple(sorted(data.items())))
+        if key in self._open:
+            if merge is not None:
+                self._open[key] = merge(self._open[key], data)
+            return
+        if merge is None:
+            self._hass.bus.async_fire(event_type, data)
+            self._open[key] = None
+        else:
+            self._open[key] = data
+        self._counter += 1
+        deadline = self._hass.loop.time() + (window or self.WINDOW)
+        heapq.heappush(self._deadlines, (deadline, self._counter, key, event_type))
+        self._schedule()
+
+    @callback
+    def _schedule(self):
+        if not self._deadlines:
+            return
+        deadline = self._deadlines[0][0]
+        if self._handle is not None:
+            if self._handle_at <= deadline:
+                return
+            self._handle.cancel()
+        self._handle = self._hass.loop.call_at(deadline, self._expire)
+        self._handle_at = deadline
+
+    @callback
+    def _expire(self):
+        self._handle = None
+        now = self._hass.loop.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, key, event_type = heapq.heappop(self._deadlines)
+            pending = self._open.pop(key)
+            if pending is not None:
+                self._hass.bus.async_fire(event_type, pending)
+        self._schedule()
+
+class XiaomiTimerWheel:
+    """Hierarchical timer wheel with one second resolution.
+
+    Level n has SLOTS slots of SLOTS ** n seconds each. A timer goes into
+    the coarsest level its delay needs and moves down one level whenever
+    its slot comes up, until it fires from level 0. Adding and cancelling
+    are O(1) however many timers are pending, and a single loop timer
+    ticks once a second while any is.
+    """
+    SLOTS = 64
+    LEVELS = 3
+
+    def __init__(self, hass):
+        self._hass = hass
+        self._wheels = [[[] for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self._tick = 0
+        self._origin = None
+        self._pending = 0
+        self._handle = None
+
+    @callback
+    def schedule(self, delay, action, *args):
+        """Call action(*args) in about delay seconds and return a handle."""
+        if self._origin is None:
+            self._origin = self._hass.loop.time() - self._tick
+        timer = [self._tick + max(int(round(delay)), 1), action, args]
+        self._insert(timer)
+        self._pending += 1
+        if self._handle is None:
+            self._handle = self._hass.loop.call_later(1, self._advance)
+        return timer
+
+    @callback
+    def cancel(self, timer):
+        """Cancel a timer returned by schedule."""
+        if timer[1] is not None:
+            timer[1] = None
+            self._pending -= 1
+
+    def _insert(self, timer):
+        delta = timer[0] - self._tick
+        for level in range(self.LEVELS):
+            span = self.SLOTS ** level
+            if delta < span * self.SLOTS or level == self.LEVELS - 1:
+                self._wheels[level][(timer[0] // span) % self.SLOTS].append(timer)
+                return
+
+    @callback
+    def _advance(self):
+        self._handle = None
+        now = int(self._hass.loop.time() - self._origin)
+        while self._tick < now:
+            self._tick += 1
+            for level in range(self.LEVELS - 1, 0, -1):
+                span = self.SLOTS ** level
+                if self._tick % span == 0:
+                    slot = self._wheels[level][(self._tick // span) % self.SLOTS]
+                    self._wheels[level][(self._tick // span) % self.SLOTS] = []
+                    for timer in slot:
+                        if timer[1] is not None:
+                            self._insert(timer)
+            slot = self._wheels[0][self._tick % self.SLOTS]
+            self._wheels[0][self._tick % self.SLOTS] = []
+            for timer in slot:
+                if timer[1] is None:
+                    continue
+                if timer[0] > self._tick:
+                    self._insert(timer)
+                    continue
+                action, args = timer[1], timer[2]
+                timer[1] = None
+                self._pending -= 1
+                action(*args)
+        if self._pending:
+            self._handle = self._hass.loop.call_later(1, self._advance)
+        else:
+            self._origin = None
+
+class XiaomiHealthMonitor:
+    """Watch gateway traffic and find gateways that went silent.
+
+    Gateways send a heartbeat every 10 seconds. A gateway that sent nothing
+    for HEARTBEAT_TIMEOUT seconds is marked unavailable, and a whois is run
+    in the background so a gateway that changed IP is followed to it. The
+    same check marks the devices of every gateway stale or fresh.
+    """
+    CHECK_INTERVAL = 30
+    HEARTBEAT_TIMEOUT = 60
+    WHOIS_TIMEOUT = 5.0
+
+    def __init__(self, hass, xiaomi_gateway):
+        self._hass = hass
+        self._xiaomi_gateway = xiaomi_gateway
+        self._searching = False
+        self._handle = None
+
+    @callback
+    def async_start(self):
+        """Start the periodic check."""
+        if self._handle is None:
+            self._handle = self._hass.loop.call_later(self.CHECK_INTERVAL, self._check)
+
+    def stop(self):
+        """Stop the periodic check. Safe to call from any thread."""
+        self._hass.loop.call_soon_threadsafe(self._async_stop)
+
+    @callback
+    def _async_stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    @callback
+    def _check(self):
+        now = time.monotonic()
+        silent = [gateway for gateway in self._xiaomi_gateway.gateways.values()
+                  if now - gateway.last_seen > self.HEARTBEAT_TIMEOUT]
+        for gateway in silent:
+            gateway.set_available(False)
+        for gateway in self._xiaomi_gateway.gateways.values():
+            gateway.check_devices(now)
+        if silent and not self._searching:
+            self._searching = True
+            self._hass.async_add_job(self._async_rediscover([gateway.sid for gateway in silent]))
+        self._handle = self._hass.loop.call_later(self.CHECK_INTERVAL, self._check)
+
+    @asyncio.coroutine
+    def _async_rediscover(self, sids):
+        try:
+            found = yield from self._hass.loop.run_in_executor(
+                None, self._xiaomi_gateway.whois, sids, self.WHOIS_TIMEOUT)
+            for sid, (ip_add, port) in found.items():
+                self._xiaomi_gateway.move_gateway(sid, ip_add, port)
+        finally:
+            self._searching = False
+
+class XiaomiGateway:
+    """Xiaomi Gateway Component"""
+    READ_WINDOW = 8
+    READ_RETRY = 3
+    COMMAND_TIMEOUT = 5.0
+    COMMAND_RETRY = 0
+
+    def __init__(self, hass, ip, port, sid, key, sock, dispatcher, stats, capture, events,
+                 timers):
+
+        self.hass = hass
+        self.ip_add = ip
+        self.port = int(port)
+        self.sid = sid
+        self.key = key
+        self.devices = defaultdict(list)
+        self.inventory = OrderedDict()
+        self.ha_devices = []
+        self.available = True
+        self.last_seen = time.monotonic()
+        self._started = self.last_seen
+        self._device_seen = {}
+        self._stale = set()
+        self._unverified = set()
+        self._dispatcher = dispatcher
+        self._stats = stats
+        self._capture = capture
+        self.events = events
+        self.timers = timers
+        self._token = None
+        self._key = None
+        self._key_token = None
+        self._cipher = None
+
+        self._socket = sock
+        self._mux = None
+        self.poll_scheduler = XiaomiPollScheduler(hass, self)
+
+        options = hass.data.get(DOMAIN, {})
+        self.command_timeout = options.get('command_timeout', self.COMMAND_TIMEOUT)
+        self.command_retries = options.get('command_retries', self.COMMAND_RETRY)
+        self.optimistic = options.get('optimistic', False)
+        self._stale_after = options.get('stale_after', STALE_AFTER)
+        # Read acks come from the gateway's cache, write acks over the radio
+        self.rtt = {}
+
+    @asyncio.coroutine
+    def async_connect(self):
+        """Attach the gateway socket to the command multiplexer."""
+        _, self._mux = yield from self.hass.loop.create_datagram_endpoint(
+            lambda: XiaomiCommandMux(self.hass.loop, self._capture), sock=self._socket)
+
+    @asyncio.coroutine
+    def async_discover_devices(self, announce=False):
+        """Discover the devices attached to the gateway.
+
+        Devices already in the inventory are not read again. With announce,
+        newly found devices are signalled to the platforms.
+        """
+        trycount = 5
+        for attempt in range(trycount):
+            _LOGGER.info('Discovering Xiaomi Devices')
+            if (yield from self._async_discover_devices(announce, attempt)):
+                break
+
+    def load_inventory(self, devices):
+        """Populate the gateway from cached device records.
+
+        The cached devices stay unverified until async_verify_devices
+        reads them. Until then an entity only drops its unverified
+        attribute when a report carries its own data key.
+        """
+        for device in devices:
+            device['data'] = state_data(device['model'], device.get('data') or {})
+            self.inventory[device['sid']] = device
+            self._unverified.add(device['sid'])
+            self._classify(device)
+
+    def is_unverified(self, sid):
+        """Return True if the state of sid only comes from the cache."""
+        return sid in self._unverified
+
+    @asyncio.coroutine
+    def async_verify_devices(self):
+        """Read the cached devices that have not been read since startup."""
+        sids = [sid for sid in self.inventory if sid in self._unverified]
+        if sids:
+            _LOGGER.info('Refreshing %s cached devices', len(sids))
+            yield from self._async_read_all(sids, self.push_data)
+
+    def close(self):
+        """Close the gateway socket."""
+        self.poll_scheduler.stop()
+        if self._mux is not None:
+            self.hass.loop.call_soon_threadsafe(self._mux.close)
+            self._mux = None
+        elif self._socket is not None:
+            self._socket.close()
+        self._socket = None
+
+    @asyncio.coroutine
+    def _async_discover_devices(self, announce, attempt):
+
+        cmd = '{"cmd" : "get_id_list"}'
+        resp = yield from self.async_send_cmd(cmd, "get_id_list_ack", attempt=attempt)
+        if resp is None or resp.token is None or resp.data is None:
+            return False
+        self.update_key(resp.token)
+        sids = list(resp.data)
+        sids.append(self.sid)
+
+        _LOGGER.info('Found %s devices', len(sids))
+
+        for sid in set(self.inventory) - set(sids):
+            _LOGGER.warning('Cached device %s is no longer paired with gateway %s',
+                            sid, self.sid)
+            self._remove_device(sid)
+        sids = [sid for sid in sids if sid not in self.inventory]
+
+        yield from self._async_read_all(sids, lambda resp: self._add_device(resp, announce))
+        return True
+
+    @asyncio.coroutine
+    def _async_read_all(self, sids, handler):
+        """Read sids, retrying the ones that did not answer."""
+        for attempt in range(self.READ_RETRY):
+            if not sids:
+                break
+            sids = yield from self._async_read_devices(sids, handler, attempt)
+            if not sids:
+                break
+            _LOGGER.info('Retrying %s devices that did not answer', len(sids))
+
+        for sid in sids:
+            _LOGGER.error('No response from device %s', sid)
+
+    @asyncio.coroutine
+    def _async_read_devices(self, sids, handler, attempt):
+        """Read devices keeping up to READ_WINDOW requests in flight.
+
+        Every answer is passed to handler. Returns the sids that did not answer.
+        """
+        window = asyncio.Semaphore(self.READ_WINDOW, loop=self.hass.loop)
+
+        @asyncio.coroutine
+        def read(sid):
+            cmd = '{"cmd":"read","sid":"' + sid + '"}'
+            with (yield from window):
+                return (yield from self.async_send_cmd(cmd, "read_ack", sid,
+                                                       attempt=attempt))
+
+        responses = yield from asyncio.gather(*[read(sid) for sid in sids],
+                                              loop=self.hass.loop)
+        failed = []
+        for sid, resp in zip(sids, responses):
+            if resp is None:
+                failed.append(sid)
+            else:
+                handler(resp)
+        return failed
+
+    def _add_device(self, resp, announce):
+        data = resp.data
+        if data is None or "error" in data:
+            _LOGGER.error("Not a device")
+            return
+
+        xiaomi_device = {
+            "model":resp.model,
+            "sid":resp.sid,
+            "short_id":resp.short_id,
+            "data":data
+        }
+        self.inventory[resp.sid] = xiaomi_device
+
+        for component in self._classify(xiaomi_device):
+            if announce:
+                async_dispatcher_send(self.hass, SIGNAL_NEW_DEVICE.format(component),
+                                      self, xiaomi_device)
+
+    def _remove_device(self, sid):
+        """Forget a cached device that is no longer paired.
+
+        It is dropped from the inventory, so it is not cached again, and
+        its entities stay unavailable until Home Assistant restarts.
+        """
+        self.inventory.pop(sid)
+        for component, devices in self.devices.items():
+            self.devices[component] = [device for device in devices if device['sid'] != sid]
+        self._dispatcher.unregister(self.sid, sid)
+        self._unverified.discard(sid)
+        self._device_seen.pop(sid, None)
+        self._stale.add(sid)
+        self._update_devices(sid)
+
+    def _classify(self, xiaomi_device):
+        """Add the device to the components it belongs to and return them."""
+        model = xiaomi_device['model']
+        components = MODEL_COMPONENTS.get(model)
+        if components is None:
+            _LOGGER.error('Unsupported devices : %s', model)
+            return ()
+
+        #Ignore switches without API key
+        if self.key == DEFAULT_KEY:
+            components = [component for component in components
+                          if component not in KEYED_COMPONENTS]
+
+        for component in components:
+            self.devices[component].append(xiaomi_device)
+        return components
+
+    @asyncio.coroutine
+    def async_send_cmd(self, cmd, rtn_cmd, sid=None, timeout=None, attempt=0):
+        """Send cmd to the gateway and wait for the rtn_cmd reply.
+
+        Without an explicit timeout the wait is the gateway's retransmission
+        timeout, backed off for the attempt-th resend of the same command.
+        """
+        if self._mux is None:
+            _LOGGER.error("Gateway %s is not connected", self.sid)
+            return None
+        estimator = self.rtt.get(rtn_cmd)
+        if estimator is None:
+            estimator = self.rtt[rtn_cmd] = XiaomiRttEstimator(self.command_timeout)
+        adaptive = timeout is None
+        rto = estimator.rto
+        if adaptive:
+            timeout = estimator.timeout(attempt)
+        sent = time.monotonic()
+        resp = yield from self._mux.async_send(cmd, (self.ip_add, self.port),
+                                               rtn_cmd, sid, timeout)
+        if resp is None:
+            self._stats.timeouts[self.sid] += 1
+            if adaptive:
+                estimator.timed_out(rto)
+            _LOGGER.error("Cannot connect to Gateway")
+        else:
+            rtt = time.monotonic() - sent
+            self._stats.ack_rtt.add(rtt)
+            # A reply to a resent command may answer any of the sends (Karn)
+            if attempt == 0:
+                estimator.add(rtt)
+        return resp
+
+    def _send_cmd(self, cmd, rtn_cmd, sid=None):
+        return asyncio.run_coroutine_threadsafe(
+            self.async_send_cmd(cmd, rtn_cmd, sid), self.hass.loop).result()
+
+    def _write_cmd(self, sid, values, key):
+        data = dict(values)
+        data['key'] = key
+        cmd = {}
+        cmd['cmd'] = 'write'
+        cmd['sid'] = sid
+        cmd['data'] = data
+        return json.dumps(cmd)
+
+    @asyncio.coroutine
+    def _async_write(self, sid, values, key):
+        """Write values to sid, resending up to command_retries times without an ack."""
+        cmd = self._write_cmd(sid, values, key)
+        for attempt in range(self.command_retries + 1):
+            if attempt:
+                _LOGGER.info('Resending write to %s (retry %s)', sid, attempt)
+            resp = yield from self.async_send_cmd(cmd, "write_ack", sid, attempt=attempt)
+            if resp is not None:
+                return self._validate_data(resp)
+        return False
+
+    def write_to_hub(self, sid, data_key, datavalue):
+        """Send data to gateway to turn on / off device"""
+        return asyncio.run_coroutine_threadsafe(
+            self.async_write_to_hub(sid, data_key, datavalue), self.hass.loop).result()
+
+    @asyncio.coroutine
+    def async_write_to_hub(self, sid, data_key, datavalue):
+        """Send data to gateway to turn on / off device"""
+        return (yield from self.async_write_to_hub_multi(sid, **{data_key: datavalue}))
+
+    def write_to_hub_multi(self, sid, **kwargs):
+        """Send data to gateway to turn on / off device"""
+        return asyncio.run_coroutine_threadsafe(
+            self.async_write_to_hub_multi(sid, **kwargs), self.hass.loop).result()
+
+    @asyncio.coroutine
+    def async_write_to_hub_multi(self, sid, **kwargs):
+        """Send data to gateway to turn on / off device"""
+        key = self._get_key()
+        if key is None:
+            return False
+        return (yield from self._async_write(sid, kwargs, key))
+
+    def write_to_hub_many(self, writes):
+        """Send several writes at once, see async_write_to_hub_many."""
+        return asyncio.run_coroutine_threadsafe(
+            self.async_write_to_hub_many(writes), self.hass.loop).result()
+
+    @asyncio.coroutine
+    def async_write_to_hub_many(self, writes):
+        """Send writes back-to-back and wait for all acks concurrently.
+
+        writes is a list of (sid, {data_key: value}) tuples. Writes to the
+        same sid are merged into one command. Returns one boolean per entry.
+        """
+        key = self._get_key()
+        if key is None:
+            return [False] * len(writes)
+
+        merged = OrderedDict()
+        for sid, values in writes:
+            merged.setdefault(sid, {}).update(values)
+
+        responses = yield from asyncio.gather(
+            *[self._async_write(sid, values, key) for sid, values in merged.items()],
+            loop=self.hass.loop)
+        results = dict(zip(merged, responses))
+        return [results[sid] for sid, _ in writes]
+
+    def get_from_hub(self, sid):
+        """Get data from gateway"""
+        cmd = '{ "cmd":"read","sid":"' + sid + '"}'
+        resp = self._send_cmd(cmd, "read_ack", sid)
+        return self.push_data(resp)
+
+    @asyncio.coroutine
+    def async_get_from_hub(self, sid):
+        """Get data from gateway"""
+        cmd = '{ "cmd":"read","sid":"' + sid + '"}'
+        resp = yield from self.async_send_cmd(cmd, "read_ack", sid)
+        return self.push_data(resp)
+
+    def push_data(self, msg):
+        """Push a decoded message broadcasted from gateway to device"""
+        if not self._validate_data(msg):
+            return False
+        if msg.cmd == 'read_ack':
+            # Only a read returns every value of the device
+            self._unverified.discard(msg.sid)
+        self._device_seen[msg.sid] = time.monotonic()
+        if msg.sid in self._stale:
+            self._stale.discard(msg.sid)
+            self._update_devices(msg.sid)
+        device = self.inventory.get(msg.sid)
+        if device is not None:
+            device['data'].update(state_data(device['model'], msg.data))
+        return self._dispatcher.dispatch(self.sid, msg.sid, msg.data)
+
+    @callback
+    def set_available(self, available):
+        """Mark the gateway and its entities available or unavailable."""
+        if available == self.available:
+            return
+        if available:
+            _LOGGER.warning('Xiaomi Gateway %s is back', self.sid)
+        else:
+            _LOGGER.error('No heartbeat from Xiaomi Gateway %s at %s', self.sid, self.ip_add)
+        self.available = available
+        self._update_devices()
+
+    @callback
+    def check_devices(self, now):
+        """Mark the devices not heard from within their model's limit stale."""
+        default = self._stale_after['default']
+        for sid, device in self.inventory.items():
+            if sid == self.sid:
+                continue
+            limit = self._stale_after.get(device['model'], default)
+            stale = now - self._device_seen.get(sid, self._started) > limit
+            if stale == (sid in self._stale):
+                continue
+            if stale:
+                _LOGGER.warning('No report from %s %s for %s seconds', device['model'], sid, limit)
+                self._stale.add(sid)
+            else:
+                self._stale.discard(sid)
+            self._update_devices(sid)
+
+    def is_available(self, sid):
+        """Return True if the gateway and sid were heard from recently."""
+        return self.available and sid not in self._stale
+
+    @callback
+    def _update_devices(self, sid=None):
+        for device in self.ha_devices:
+            if device.hass is not None and (sid is None or device.sid == sid):
+                device.async_schedule_update_ha_state()
+
+    def register_device(self, device):
+        """Route reports carrying the device's data keys to it."""
+        self.ha_devices.append(device)
+        self._dispatcher.register(self.sid, device.sid, device.data_keys, device)
+
+    def update_key(self, token, key=None):
+        """Update key using token from gateway, or store a key derived elsewhere"""
+        self._token = token
+        if key is not None:
+            self._key = key
+            self._key_token = token
+
+    def _get_key(self):
+        """Return the write key, deriving it only when the token changed."""
+        if self._token is None:
+            return None
+        if self._key_token != self._token:
+            if self._cipher is None:
+                from Crypto.Cipher import AES
+                self._cipher = AES.new(self.key.encode(), AES.MODE_ECB)
+            self._key = derive_key(self._cipher, self._token)
+            self._key_token = self._token
+        return self._key
+
+    def _validate_data(self, msg):
+        if msg is None or msg.data is None:
+            _LOGGER.error('No data in response from hub %s', msg)
+            return False
+        if 'error' in msg.data:
+            _LOGGER.error('Got error element in data %s', msg.data)
+            return False
+        return True
+
+class XiaomiDevice(Entity):
+    """Representation a base Xiaomi device.
+
+    State attributes live in one dict per entity that parse_data updates in
+    place, starting from DEFAULT_ATTRIBUTES. Home Assistant copies it on
+    every state write, so returning it as is never leaks later changes.
+    """
+    DEFAULT_ATTRIBUTES = {}
+
+    def __init__(self, device, name, xiaomi_hub):
+        """Initialize the xiaomi device."""
+        self._sid = device['sid']
+        self._name = '{}_{}'.format(name, self._sid)
+        self._device_state_attributes = dict(self.DEFAULT_ATTRIBUTES)
+        self._pending_write = None
+        self._since_timers = []
+        self.xiaomi_hub = xiaomi_hub
+
+        if xiaomi_hub.is_unverified(self._sid):
+            self._device_state_attributes[ATTR_UNVERIFIED] = True
+
+        data = device.get('data') or {}
+        self.parse_data(data)
+        self._parse_voltage(data)
+
+        xiaomi_hub.register_device(self)
+
+    @property
+    def name(self):
+        """Return the name of the device."""
+        return self._name
+
+    @property
+    def sid(self):
+        """Return the sid of the device."""
+        return self._sid
+
+    @property
+    def data_keys(self):
+        """Return the report keys consumed by the device."""
+        return (self._data_key, VOLTAGE)
+
+    @property
+    def should_poll(self):
+        """Poll update device status"""
+        return False
+
+    @property
+    def available(self):
+        """Return True while the device and its gateway are heard from."""
+        return self.xiaomi_hub.is_available(self._sid)
+
+    @property
+    def device_state_attributes(self):
+        """Return the state attributes."""
+        return self._device_state_attributes
+
+    def push_data(self, data):
+        """Push from Hub"""
+        _LOGGER.debug("PUSH >> %s: %s", self, data)
+
+        was_unverified = False
+        if self._data_key in data or not self.xiaomi_hub.is_unverified(self._sid):
+            was_unverified = self._device_state_attributes.pop(ATTR_UNVERIFIED, False)
+        if self._data_key in data:
+            # A report is authoritative over a write still waiting for its ack
+            self._pending_write = None
+        self._parse_voltage(data)
+
+        if self.parse_data(data) or was_unverified:
+            self.async_schedule_update_ha_state()
+
+    def parse_data(self, data):
+        """Parse data sent by gateway"""
+        raise NotImplementedError()
+
+    def command_data(self, state):
+        """Return the write data that turns the device on or off."""
+        return None
+
+    @asyncio.coroutine
+    def async_apply_command(self, state, ack):
+        """Track a write of command_data(state) that the caller sends in a batch.
+
+        ack resolves to whether the gateway acknowledged the write.
+        """
+        yield from self._async_write_state(self.command_data(state), {'_state': state}, ack)
+
+    @asyncio.coroutine
+    def _async_write_state(self, values, state, ack=None):
+        """Write values to the device and set the attributes in state.
+
+        Normally state is set once the gateway acknowledges the write. In
+        optimistic mode it is set right away and rolled back if the write
+        is not acknowledged, unless a report arrived in the meantime. ack
+        replaces the write when the caller sends it itself.
+        """
+        if ack is None:
+            ack = self.xiaomi_hub.async_write_to_hub_multi(self._sid, **values)
+        if not self.xiaomi_hub.optimistic:
+            if (yield from ack):
+                self._apply_state(state)
+            return
+
+        previous = {name: getattr(self, name) for name in state}
+        self._pending_write = pending = object()
+        self._apply_state(state)
+        acked = yield from ack
+        if self._pending_write is not pending:
+            return
+        self._pending_write = None
+        if not acked:
+            _LOGGER.warning('Write %s to %s was not acknowledged, rolling back', values, self._sid)
+            self._apply_state(previous)
+
+    def _fire_event(self, event_type, data, **kwargs):
+        """Fire event_type for this entity, see XiaomiEventEmitter.async_fire.
+
+        Nothing is fired before the entity is added, when parse_data only
+        restores the last known state.
+        """
+        if self.hass is None:
+            return
+        data['entity_id'] = self.entity_id
+        self.xiaomi_hub.events.async_fire(event_type, data, **kwargs)
+
+    def _track_since(self, thresholds, event_type, attribute):
+        """Count from now, setting attribute and firing event_type at each threshold.
+
+        The thresholds are seconds. The event carries the elapsed seconds as
+        since, so automations need no timers of their own.
+        """
+        self._untrack_since()
+        if self.hass is None:
+            return
+        self._since_timers = [
+            self.xiaomi_hub.timers.schedule(seconds, self._async_since_passed,
+                                            seconds, event_type, attribute)
+            for seconds in thresholds]
+
+    def _untrack_since(self):
+        for timer in self._since_timers:
+            self.xiaomi_hub.timers.cancel(timer)
+        self._since_timers = []
+
+    @callback
+    def _async_since_passed(self, seconds, event_type, attribute):
+        self._device_state_attributes[attribute] = seconds
+        self._fire_event(event_type, {'since': seconds})
+        self.async_schedule_update_ha_state()
+
+    def _apply_state(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.async_schedule_update_ha_state()
+
+    def _parse_voltage(self, data):
+        if VOLTAGE in data:
+            max_volt = 3300
+            min_volt = 2800
+
+            voltage = data[VOLTAGE]
+            if voltage > max_volt:
+                voltage = max_volt
+            elif voltage < min_volt:
+                voltage = min_volt
+            percent = ((voltage - min_volt) / (max_volt - min_volt)) * 100
+            self._device_state_attributes[ATTR_BATTERY_LEVEL] = round(percent)
@@ -0,0 +1,147 @@
+"""
+Benchmark the Xiaomi component against a simulated gateway.
+
+Measures device discovery time, multicast report throughput through
+_handle_mcast_msg -> push_data and write-ack latency for several device
+counts. Needs Home Assistant and pycrypto installed, no hardware.
+
+    python tools/benchmark.py --devices 10 100 1000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from homeassistant.core import HomeAssistant  # noqa: E402
+from components import xiaomi  # noqa: E402
+from gateway_sim import GatewaySimulator, model_data  # noqa: E402
+
+KEY = '0123456789abcdef'
+
+
+class CountingEntity:
+    """Dispatch target that only counts the reports it receives."""
+
+    def __init__(self, sid, data_keys):
+        self.sid = sid
+        self.data_keys = data_keys
+        self.count = 0
+
+    def push_data(self, data):
+        """Count a report."""
+        self.count += 1
+
+
+def start_hass():
+    """Return a Home Assistant core running its loop in a thread."""
+    loop = asyncio.new_event_loop()
+    hass = HomeAssistant(loop)
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    return hass
+
+
+def run_on_loop(hass, func, *args):
+    """Run func(*args) on the event loop and return its result."""
+    @asyncio.coroutine
+    def wrapper():
+        return func(*args)
+    return asyncio.run_coroutine_threadsafe(wrapper(), hass.loop).result()
+
+
+def percentile(samples, fraction):
+    """Return the fraction-th sample of samples."""
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def feed_reports(xiaomi_gateway, packets, addr):
+    """Push pre-encoded datagrams through the multicast handler."""
+    start = time.perf_counter()
+    for packet in packets:
+        xiaomi_gateway._handle_mcast_msg(packet, addr)
+    return time.perf_counter() - start
+
+
+def bench(hass, devices, reports, writes, latency, sleepy):
+    """Run all measurements for one device count."""
+    sim = GatewaySimulator(port=0, devices=devices, latency=latency, sleepy=sleepy)
+    sim.start(whois=False)
+    xiaomi_gateway = xiaomi.PyXiaomiGateway(hass, [{'sid': sim.sid, 'key': KEY}], 'any')
+    gateway = xiaomi_gateway.add_gateway(sim.ip, sim.port, sim.sid, KEY)
+    result = {'devices': devices}
+
+    start = time.perf_counter()
+    xiaomi_gateway.connect_gateways()
+    xiaomi_gateway.discover_devices()
+    result['startup_s'] = time.perf_counter() - start
+    result['discovered'] = len({device['sid'] for component in gateway.devices.values()
+                                for device in component})
+
+    for sid, model in sim.devices.items():
+        gateway.register_device(CountingEntity(sid, list(model_data(model))))
+    sids = list(sim.devices)
+    packets = [sim.report(random.choice(sids)) for _ in range(reports)]
+    elapsed = run_on_loop(hass, feed_reports, xiaomi_gateway, packets, (sim.ip, sim.port))
+    result['reports_per_s'] = reports / elapsed
+
+    plugs = [sid for sid, model in sim.devices.items() if model == 'plug']
+    result['write_many_count'] = len(plugs)
+    if plugs:
+        samples = []
+        for index in range(writes):
+            start = time.perf_counter()
+            gateway.write_to_hub(plugs[index % len(plugs)], 'status', 'on')
+            samples.append(time.perf_counter() - start)
+        result['write_p50_ms'] = percentile(samples, 0.5) * 1000
+        result['write_p95_ms'] = percentile(samples, 0.95) * 1000
+
+        start = time.perf_counter()
+        gateway.write_to_hub_many([(sid, {'status': 'off'}) for sid in plugs])
+        result['write_many_ms'] = (time.perf_counter() - start) * 1000
+    else:
+        # Too few devices for the simulator to include a plug to write to
+        result['write_p50_ms'] = result['write_p95_ms'] = result['write_many_ms'] = float('nan')
+
+    xiaomi_gateway.stop_listen()
+    sim.stop()
+    return result
+
+
+def main():
+    """Run the benchmark and print one line per device count."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--devices', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--reports', type=int, default=100000,
+                        help='reports pushed through the dispatch path')
+    parser.add_argument('--writes', type=int, default=200,
+                        help='sequential writes timed for the latency figures')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the simulator waits before every reply')
+    parser.add_argument('--sleepy', type=float, default=0.0,
+                        help='fraction of devices that miss their first read')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    hass = start_hass()
+    hass.data[xiaomi.DOMAIN] = {}
+    print('devices  discovered  startup_s  reports/s  write_p50_ms  write_p95_ms  '
+          'write_many_ms (n)')
+    for devices in args.devices:
+        result = bench(hass, devices, args.reports, args.writes, args.latency, args.sleepy)
+        print('{devices:7d}  {discovered:10d}  {startup_s:9.3f}  {reports_per_s:9.0f}  '
+              '{write_p50_ms:12.2f}  {write_p95_ms:12.2f}  {write_many_ms:13.2f} '
+              '({write_many_count})'.format(**result))
+    hass.loop.call_soon_threadsafe(hass.loop.stop)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Simulated Xiaomi Gateway for offline testing and benchmarking.
+
+Answers whois, get_id_list, read and write like a real gateway and can
+emit synthetic report and heartbeat streams to the multicast group.
+
+    python tools/gateway_sim.py --devices 100 --report-rate 50
+"""
+import argparse
+import json
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+MULTICAST_ADDRESS = '224.0.0.50'
+MULTICAST_PORT = 9898
+GATEWAY_DISCOVERY_PORT = 4321
+
+MODELS = ['motion', 'magnet', 'sensor_ht', 'switch', 'plug', 'ctrl_neutral2', 'cube', '86sw2']
+
+
+def model_data(model, rng=random):
+    """Return a plausible data payload for model, drawn from rng."""
+    voltage = rng.randint(2800, 3300)
+    if model == 'motion':
+        return {'voltage': voltage, 'status': rng.choice(['motion', 'no_motion'])}
+    if model == 'magnet':
+        return {'voltage': voltage, 'status': rng.choice(['open', 'close'])}
+    if model == 'sensor_ht':
+        return {'voltage': voltage, 'temperature': str(rng.randint(1500, 3000)),
+                'humidity': str(rng.randint(3000, 7000))}
+    if model == 'switch':
+        return {'voltage': voltage, 'status': rng.choice(['click', 'double_click'])}
+    if model == 'plug':
+        return {'voltage': 3600, 'status': rng.choice(['on', 'off']), 'inuse': '1',
+                'load_power': str(rng.randint(0, 2000)),
+                'power_consumed': str(rng.randint(0, 100000))}
+    if model == 'ctrl_neutral2':
+        return {'channel_0': rng.choice(['on', 'off']),
+                'channel_1': rng.choice(['on', 'off'])}
+    if model == 'cube':
+        return {'voltage': voltage, 'status': rng.choice(['flip90', 'move', 'shake_air'])}
+    if model == '86sw2':
+        return {'voltage': voltage, 'channel_0': 'click'}
+    return {'voltage': voltage}
+
+
+class GatewaySimulator:
+    """Stand-in gateway serving the LAN protocol on the local host."""
+
+    def __init__(self, sid='34ce00000001', ip='127.0.0.1', port=9898, devices=10,
+                 latency=0.0, sleepy=0.0, seed=0):
+        self._random = random.Random(seed)
+        self.sid = sid
+        self.ip = ip
+        self.port = port
+        self.latency = latency
+        self.token = '{:016x}'.format(self._random.getrandbits(64))
+        self.devices = {}
+        self._sleepy = set()
+        for index in range(devices):
+            sid = '158d{:010x}'.format(index + 1)
+            self.devices[sid] = MODELS[index % len(MODELS)]
+            if self._random.random() < sleepy:
+                self._sleepy.add(sid)
+        self.devices[self.sid] = 'gateway'
+
+        self._running = False
+        self._threads = []
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((ip, port))
+        self.port = self._socket.getsockname()[1]
+        self._mcast_out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._mcast_out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+
+    def start(self, whois=True, report_rate=0):
+        """Serve requests, and optionally whois and reports, in threads."""
+        self._running = True
+        targets = [self._serve_unicast]
+        if whois:
+            targets.append(self._serve_whois)
+        if report_rate:
+            targets.append(lambda: self._emit_reports(report_rate))
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop serving."""
+        self._running = False
+        self._socket.close()
+        self._mcast_out.close()
+
+    def report(self, sid, cmd='report'):
+        """Return an encoded report or heartbeat datagram for sid."""
+        model = self.devices[sid]
+        msg = {'cmd': cmd, 'model': model, 'sid': sid, 'short_id': 0,
+               'data': json.dumps(model_data(model, self._random))}
+        if model == 'gateway':
+            msg['token'] = self.token
+        return json.dumps(msg).encode()
+
+    def _serve_unicast(self):
+        while self._running:
+            try:
+                data, addr = self._socket.recvfrom(1024)
+            except OSError:
+                return
+            try:
+                resp = self._handle(json.loads(data.decode()))
+            except (ValueError, KeyError):
+                _LOGGER.error('Bad request %s', data)
+                continue
+            if resp is None:
+                continue
+            if self.latency:
+                # Delay each reply on its own so concurrent requests overlap
+                timer = threading.Timer(self.latency, self._reply, (resp, addr))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._reply(resp, addr)
+
+    def _reply(self, resp, addr):
+        try:
+            self._socket.sendto(json.dumps(resp).encode(), addr)
+        except OSError as err:
+            _LOGGER.error('Cannot send reply: %s', err)
+
+    def _handle(self, req):
+        cmd = req['cmd']
+        if cmd == 'get_id_list':
+            sids = [sid for sid in self.devices if sid != self.sid]
+            return {'cmd': 'get_id_list_ack', 'sid': self.sid, 'token': self.token,
+                    'data': json.dumps(sids)}
+        if cmd == 'read':
+            sid = req['sid']
+            if sid in self._sleepy:
+                self._sleepy.discard(sid)
+                return None
+            model = self.devices.get(sid)
+            if model is None:
+                return {'cmd': 'read_ack', 'sid': sid,
+                        'data': json.dumps({'error': 'No device'})}
+            return {'cmd': 'read_ack', 'model': model, 'sid': sid, 'short_id': 0,
+                    'data': json.dumps(model_data(model, self._random))}
+        if cmd == 'write':
+            sid = req['sid']
+            data = dict(req['data'])
+            data.pop('key', None)
+            return {'cmd': 'write_ack', 'model': self.devices.get(sid), 'sid': sid,
+                    'short_id': 0, 'data': json.dumps(data)}
+        _LOGGER.error('Unknown cmd %s', cmd)
+        return None
+
+    def _serve_whois(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', GATEWAY_DISCOVERY_PORT))
+        mreq = struct.pack("4sl", socket.inet_aton(MULTICAST_ADDRESS), socket.INADDR_ANY)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        sock.settimeout(1.0)
+        iam = json.dumps({'cmd': 'iam', 'model': 'gateway', 'sid': self.sid,
+                          'ip': self.ip, 'port': str(self.port)}).encode()
+        while self._running:
+            try:
+                data, addr = sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            if b'whois' in data:
+                sock.sendto(iam, addr)
+        sock.close()
+
+    def _emit_reports(self, rate):
+        sids = [sid for sid in self.devices if sid != self.sid]
+        heartbeat_at = 0
+        while self._running:
+            now = time.monotonic()
+            if now >= heartbeat_at:
+                self._send_mcast(self.report(self.sid, 'heartbeat'))
+                heartbeat_at = now + 10
+            self._send_mcast(self.report(self._random.choice(sids)))
+            time.sleep(1.0 / rate)
+
+    def _send_mcast(self, data):
+        try:
+            self._mcast_out.sendto(data, (MULTICAST_ADDRESS, MULTICAST_PORT))
+        except OSError as err:
+            _LOGGER.error('Cannot send multicast report: %s', err)
+
+
+def main():
+    """Run a simulated gateway until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sid', default='34ce00000001')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9898)
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--report-rate', type=float, default=0,
+                        help='multicast reports per second')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added before every reply')
+    parser.add_argument('--sleepy', type=float, default=0.0,
+                        help='fraction of devices that miss their first read')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sim = GatewaySimulator(args.sid, args.ip, args.port, args.devices,
+                           args.latency, args.sleepy)
+    sim.start(report_rate=args.report_rate)
+    _LOGGER.info('Gateway %s serving %s devices on %s:%s',
+                 sim.sid, args.devices, sim.ip, sim.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Replay a captured gateway traffic file through the Xiaomi dispatch path.
+
+Capture traffic by setting `capture: xiaomi_capture.log` in the xiaomi
+configuration, then replay it offline at 1x, Nx or maximum speed:
+
+    python tools/replay.py xiaomi_capture.log --speed 50
+    python tools/replay.py xiaomi_capture.log --speed 0
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+
+from benchmark import CountingEntity, start_hass
+from components import xiaomi
+
+KEY = '0123456789abcdef'
+
+
+def build_gateways(xiaomi_gateway, records):
+    """Register the gateways and sids seen in records with counting targets."""
+    gateway_sids = {}
+    data_keys = defaultdict(set)
+    for _, kind, (ip_add, _), data in records:
+        if kind != 'mcast':
+            continue
+        try:
+            msg = xiaomi.decode_message(data)
+        except ValueError:
+            continue
+        if msg.model == 'gateway':
+            gateway_sids[ip_add] = msg.sid
+        if isinstance(msg.data, dict):
+            data_keys[(ip_add, msg.sid)].update(msg.data)
+
+    gateways = {}
+    for ip_add, sid in data_keys:
+        if ip_add not in gateways:
+            gateways[ip_add] = xiaomi_gateway.add_gateway(
+                ip_add, 9898, gateway_sids.get(ip_add, ip_add), KEY)
+    targets = []
+    for (ip_add, sid), keys in data_keys.items():
+        target = CountingEntity(sid, tuple(keys))
+        gateways[ip_add].register_device(target)
+        targets.append(target)
+    return targets
+
+
+def main():
+    """Replay a capture file and print throughput and pipeline statistics."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('capture')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed multiplier, 0 for as fast as possible')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    hass = start_hass()
+    hass.data[xiaomi.DOMAIN] = {}
+    xiaomi_gateway = xiaomi.PyXiaomiGateway(hass, [], 'any')
+    targets = build_gateways(xiaomi_gateway, xiaomi.read_capture(args.capture))
+
+    start = time.perf_counter()
+    stats = xiaomi.XiaomiStats()
+    count = asyncio.run_coroutine_threadsafe(
+        xiaomi_gateway.async_replay(args.capture, args.speed, stats), hass.loop).result()
+    elapsed = time.perf_counter() - start
+
+    print('{} datagrams in {:.2f} s ({:.0f}/s), {} reports delivered to {} sids'.format(
+        count, elapsed, count / elapsed if elapsed else 0,
+        sum(target.count for target in targets), len(targets)))
+    print(json.dumps(stats.as_dict(), indent=2, sort_keys=True))
+    xiaomi_gateway.stop_listen()
+    hass.loop.call_soon_threadsafe(hass.loop.stop)
+
+
+if __name__ == '__main__':
+    main()